@@ -1,16 +1,30 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import itertools
 import json
 import os
 import pathlib
+import queue
+import re
+import shutil
 import signal
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
 import uuid
+import zlib
 
 from requests import Session
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 from urllib3.util import Retry
 
 
@@ -24,6 +38,18 @@ V1_UA = os.environ.get(
     "TMV1_UA",
     f"Trend Vision One API Cookbook ({os.path.basename(__file__)})"
 )
+# Number of packages downloaded at the same time in continuous-get-packages
+V1_DOWNLOAD_WORKERS = int(os.environ.get("TMV1_DOWNLOAD_WORKERS", 4))
+# Size of the chunks in which packages are copied to disk
+V1_DOWNLOAD_CHUNK_SIZE = int(
+    os.environ.get("TMV1_DOWNLOAD_CHUNK_SIZE", 1024 * 1024)
+)
+# Number of attempts to download a package, each resuming where the
+# previous one was interrupted
+V1_DOWNLOAD_ATTEMPTS = int(os.environ.get("TMV1_DOWNLOAD_ATTEMPTS", 10))
+# Size in bytes of uncompressed records after which a partition segment
+# written by continuous-get-packages is completed and a new one started
+V1_SEGMENT_SIZE = int(os.environ.get("TMV1_SEGMENT_SIZE", 128 * 1024 * 1024))
 
 
 class TmV1Client:
@@ -44,7 +70,7 @@ class TmV1Client:
     # Interval choices for continuous operations (in seconds)
     interval_choices = [60, 120, 180, 300, 600]
 
-    def __init__(self, token, base_url=None):
+    def __init__(self, token, base_url=None, pool_maxsize=10):
         if not token:
             raise ValueError("Authentication token missing")
         self.endpoint_url = (base_url or self.base_url_default) + "{api}"
@@ -57,7 +83,10 @@ class TmV1Client:
             allowed_methods=["GET"],
             backoff_factor=1,
         )
-        http_adapter = HTTPAdapter(max_retries=retry)
+        # one connection per download worker
+        http_adapter = HTTPAdapter(
+            max_retries=retry, pool_maxsize=pool_maxsize
+        )
         self.session.mount("https://", http_adapter)
 
     def get_headers(self):
@@ -68,18 +97,17 @@ class TmV1Client:
             "User-Agent": self.user_agent,
         }
 
-    def get_items(self, api_path, **kwargs):
+    def iter_pages(self, api_path, **kwargs):
         """
-        Generic method to get all items from a paginated API endpoint.
+        Generic method to get the pages of a paginated API endpoint one
+        at a time, each as soon as it is received.
         Args:
             api_path (str): The API path to request
             **kwargs: Additional parameters to pass to the request
         Returns:
-            dict: Response with all items combined from all pages
+            generator: Response of each page
         """
-        items = []
         next_link = None
-        last_response = None
         while True:
             try:
                 if next_link is None:
@@ -109,14 +137,41 @@ class TmV1Client:
                 )
                 raise RuntimeError(error_message) from e
             result = resp.json()
-            last_response = result
-            # Add items from this page
-            if "items" in result:
-                items.extend(result["items"])
+            yield result
             # Check for next page
             next_link = result.get("nextLink")
             if not next_link:
                 break
+
+    def iter_items(self, api_path, **kwargs):
+        """
+        Generic method to get the items of a paginated API endpoint one
+        at a time, without waiting for the following pages.
+        Args:
+            api_path (str): The API path to request
+            **kwargs: Additional parameters to pass to the request
+        Returns:
+            generator: Items of all pages
+        """
+        for result in self.iter_pages(api_path, **kwargs):
+            yield from result.get("items", [])
+
+    def get_items(self, api_path, **kwargs):
+        """
+        Generic method to get all items from a paginated API endpoint.
+        Args:
+            api_path (str): The API path to request
+            **kwargs: Additional parameters to pass to the request
+        Returns:
+            dict: Response with all items combined from all pages
+        """
+        items = []
+        last_response = None
+        for result in self.iter_pages(api_path, **kwargs):
+            last_response = result
+            # Add items from this page
+            if "items" in result:
+                items.extend(result["items"])
         # Create a response that mimics the API structure but with all items
         return {
             "items": items,
@@ -285,33 +340,127 @@ class TmV1Client:
         }
         return self.get_items(api, params=params)
 
-    def get_datapipeline_package(self, pipeline_id, package_id):
+    def iter_datapipeline_packages(
+        self, pipeline_id,
+        start_datetime, end_datetime,
+        top=500
+    ):
+        """
+        Iterate over the available packages from a data pipeline page
+        after page, so that the packages of the first page can be used
+        while the following pages are requested.
+        Args:
+            pipeline_id (str): Unique identifier for the data pipeline
+            start_datetime (str): Start date/time for package search
+            end_datetime (str): End date/time for package search
+            top (int, optional): Maximum number of results per page
+        Returns:
+            generator: Package descriptors
+        """
+        api = f"/v3.0/datalake/dataPipelines/{pipeline_id}/packages"
+        params = {
+            "startDateTime": start_datetime,
+            "endDateTime": end_datetime,
+            "top": top,
+        }
+        return self.iter_items(api, params=params)
+
+    def download_datapipeline_package(
+        self, pipeline_id, package_id, output_path,
+        chunk_size=V1_DOWNLOAD_CHUNK_SIZE, attempts=V1_DOWNLOAD_ATTEMPTS
+    ):
         """
-        Retrieve the specified data pipeline package.
+        Download the specified data pipeline package to a file.
+        The package is streamed in fixed-size chunks to a .part file next
+        to the output file. An interrupted download, including a .part
+        file left by a previous run, is resumed from the end of the .part
+        file with a Range request instead of starting over. The .part file
+        is renamed once its size matches the size sent by the server.
         Args:
             pipeline_id (str): Unique identifier for the data pipeline
             package_id (str): Unique identifier for the package
+            output_path (str): Path of the package file
+            chunk_size (int, optional): Size of the chunks read
+            attempts (int, optional): Maximum number of requests
         Returns:
-            bytes: The raw package data
+            tuple: Size in bytes and SHA-256 checksum of the package
         """
         api = (
             f"/v3.0/datalake/dataPipelines/{pipeline_id}"
             f"/packages/{package_id}"
         )
-        resp = self.session.get(
-            self.endpoint_url.format(api=api),
-            headers=self.get_headers(), stream=True
-        )
-        print(
-            f"resp={resp}, "
-            f'trace-id={resp.headers.get("x-trace-id")}'
-        )
-        if resp.status_code != 200:
-            raise RuntimeError(
-                f'Request unsuccessful (GET {api}): '
-                f'{resp.status_code} {resp.text}'
-            )
-        return resp.raw.read()
+        output_path = pathlib.Path(output_path)
+        part_path = output_path.with_name(output_path.name + ".part")
+        with open(part_path, "ab+") as fd:
+            fd.seek(0)
+            checksum = hashlib.sha256()
+            for chunk in iter(lambda: fd.read(chunk_size), b""):
+                checksum.update(chunk)
+            size = fd.tell()
+            for attempt in range(1, attempts + 1):
+                headers = self.get_headers()
+                if size:
+                    headers["Range"] = f"bytes={size}-"
+                try:
+                    with self.session.get(
+                        self.endpoint_url.format(api=api),
+                        headers=headers, stream=True
+                    ) as resp:
+                        print(
+                            f"resp={resp}, "
+                            f'trace-id={resp.headers.get("x-trace-id")}'
+                        )
+                        start, total = get_content_range(resp)
+                        if resp.status_code == 416 and total == size:
+                            # the .part file was already complete
+                            break
+                        if resp.status_code not in [200, 206, 416]:
+                            raise RuntimeError(
+                                f'Request unsuccessful (GET {api}): '
+                                f'{resp.status_code} {resp.text}'
+                            )
+                        if resp.status_code != 206 or start != size:
+                            # the server sent the package from the start,
+                            # or the .part file is not part of the package
+                            fd.seek(0)
+                            fd.truncate()
+                            checksum = hashlib.sha256()
+                            size = 0
+                            if resp.status_code != 200:
+                                continue
+                        for chunk in resp.raw.stream(
+                            chunk_size, decode_content=False
+                        ):
+                            fd.write(chunk)
+                            size += len(chunk)
+                            checksum.update(chunk)
+                except (RequestException, ProtocolError,
+                        ReadTimeoutError) as e:
+                    print(
+                        f"  - download of {package_id} interrupted at "
+                        f"{size} bytes (attempt {attempt}/{attempts}): {e}"
+                    )
+                    if attempt < attempts:
+                        time.sleep(attempt)
+                    continue
+                if total is None or size == total:
+                    break
+                if size > total:
+                    raise RuntimeError(
+                        f"Package larger than expected (GET {api}): "
+                        f"{size} bytes, expected {total}"
+                    )
+                print(
+                    f"  - download of {package_id} incomplete at {size} "
+                    f"of {total} bytes (attempt {attempt}/{attempts})"
+                )
+            else:
+                raise RuntimeError(
+                    f"Download unsuccessful (GET {api}): {size} bytes "
+                    f"received after {attempts} attempts"
+                )
+        os.replace(part_path, output_path)
+        return size, checksum.hexdigest()
 
     def delete_datapipeline(self, pipeline_id_list):
         """
@@ -351,6 +500,640 @@ class TmV1Client:
         }]
 
 
+def get_content_range(resp):
+    """
+    Get the position of the content of a response in the whole package.
+    Args:
+        resp (Response): Response of a package download
+    Returns:
+        tuple: Offset of the first byte sent and size of the package, each
+               None when unknown
+    """
+    content_range = resp.headers.get("Content-Range", "")
+    if content_range.startswith("bytes "):
+        sent_range, _, total = content_range[6:].partition("/")
+        start = sent_range.partition("-")[0]
+        return (
+            int(start) if start.isdigit() else None,
+            int(total) if total.isdigit() else None,
+        )
+    content_length = resp.headers.get("Content-Length", "")
+    if resp.status_code == 200 and content_length.isdigit():
+        return 0, int(content_length)
+    return 0, None
+
+
+def iter_packages(
+    client, pipeline_id, package_ids, spool_path, pool, workers,
+    on_package=None
+):
+    """
+    Download packages concurrently to a spool directory and yield them in
+    the given order. At most twice as many packages as workers are
+    downloaded ahead of the package being yielded.
+    Args:
+        client (TmV1Client): API client
+        pipeline_id (str): Unique identifier for the data pipeline
+        package_ids (iterable): IDs of the packages to download
+        spool_path (Path): Directory the packages are downloaded to
+        pool (ThreadPoolExecutor): Download workers
+        workers (int): Number of workers of the pool
+        on_package (callable, optional): Called by the download workers
+                                         with the ID and the path of each
+                                         package
+    Returns:
+        generator: (package_id, path, size, checksum) tuples in package_ids
+                   order, where the file at path is deleted when the next
+                   package is yielded
+    """
+    def download(package_id):
+        path = spool_path.joinpath(f"{package_id}.gz")
+        try:
+            size, checksum = client.download_datapipeline_package(
+                pipeline_id=pipeline_id, package_id=package_id,
+                output_path=path
+            )
+        except BaseException:
+            # the package is downloaded again when it is listed again
+            path.with_name(path.name + ".part").unlink(missing_ok=True)
+            raise
+        if on_package is not None:
+            try:
+                on_package(package_id, path)
+            except BaseException:
+                path.unlink()
+                raise
+        return path, size, checksum
+
+    package_ids = iter(package_ids)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                package_id = next(package_ids, None)
+                if package_id is None:
+                    break
+                pending.append(
+                    (package_id, pool.submit(download, package_id))
+                )
+            if not pending:
+                break
+            package_id, future = pending.popleft()
+            path, size, checksum = future.result()
+            try:
+                yield package_id, path, size, checksum
+            finally:
+                path.unlink()
+    finally:
+        for _, future in pending:
+            if not future.cancel() and not future.exception():
+                future.result()[0].unlink()
+
+
+def get_bundle_manifest_path(bundle_path):
+    """
+    Get the path of the manifest written next to a bundle.
+    Args:
+        bundle_path (str): Path of the bundle
+    Returns:
+        Path: Path of the manifest
+    """
+    return pathlib.Path(f"{bundle_path}.manifest.json")
+
+
+def write_bundle_manifest(bundle_path, manifest):
+    """
+    Write the manifest of a bundle to a temporary file renamed once
+    complete, so that a bundle without a manifest is known to be
+    incomplete.
+    Args:
+        bundle_path (str): Path of the bundle
+        manifest (dict): Manifest of the bundle
+    """
+    manifest_path = get_bundle_manifest_path(bundle_path)
+    part_path = manifest_path.with_name(manifest_path.name + ".part")
+    with open(part_path, "w") as fd:
+        json.dump(manifest, fd, indent=2)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(part_path, manifest_path)
+
+
+class BundleCatalog:
+    """
+    SQLite catalog of the captured bundles and of the packages they
+    contain, shared by all the bundles of an output directory. Packages
+    are indexed by ID and SHA-256 checksum, and bundles by time window, so
+    that duplicates and the packages to process again are found without
+    reading the bundles.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the SQLite database
+        """
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS bundles ("
+                "path TEXT PRIMARY KEY,"
+                " pipeline_id TEXT NOT NULL,"
+                " start_datetime TEXT NOT NULL,"
+                " end_datetime TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " package_count INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS packages ("
+                "package_id TEXT NOT NULL,"
+                " bundle_path TEXT NOT NULL,"
+                " byte_offset INTEGER NOT NULL,"
+                " length INTEGER NOT NULL,"
+                " sha256 TEXT NOT NULL,"
+                " created_datetime TEXT,"
+                " PRIMARY KEY (bundle_path, package_id))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS bundles_start_datetime"
+                " ON bundles (start_datetime)"
+            )
+            for column in ["package_id", "sha256"]:
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS packages_{column}"
+                    f" ON packages ({column})"
+                )
+
+    def close(self):
+        self.conn.close()
+
+    def add_bundle(self, bundle_path, manifest):
+        """
+        Add a bundle and its packages, replacing any previous entry of the
+        same bundle.
+        Args:
+            bundle_path (str): Path of the bundle
+            manifest (dict): Manifest of the bundle
+        """
+        bundle_path = os.path.abspath(bundle_path)
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM packages WHERE bundle_path = ?", (bundle_path,)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO bundles (path, pipeline_id,"
+                " start_datetime, end_datetime, size, package_count)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (bundle_path, manifest["pipelineId"],
+                 manifest["startDateTime"], manifest["endDateTime"],
+                 manifest["size"], len(manifest["packages"]))
+            )
+            self.conn.executemany(
+                "INSERT INTO packages (package_id, bundle_path, byte_offset,"
+                " length, sha256, created_datetime)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(p["id"], bundle_path, p["offset"], p["length"],
+                  p["sha256"], p.get("createdDateTime"))
+                 for p in manifest["packages"]]
+            )
+
+    def has_package(self, package_id):
+        return self.conn.execute(
+            "SELECT 1 FROM packages WHERE package_id = ? LIMIT 1",
+            (package_id,)
+        ).fetchone() is not None
+
+    def get_bundles(self):
+        """
+        Returns:
+            list: Bundles as dict, oldest time window first
+        """
+        cursor = self.conn.execute(
+            "SELECT path, pipeline_id, start_datetime, end_datetime, size,"
+            " package_count FROM bundles ORDER BY start_datetime, path"
+        )
+        return [
+            dict(zip(
+                ["path", "pipelineId", "startDateTime", "endDateTime",
+                 "size", "packageCount"], row
+            ))
+            for row in cursor
+        ]
+
+    def find_packages(
+        self, package_id=None, sha256=None, start_datetime=None,
+        end_datetime=None, duplicates=False, bundle_path=None
+    ):
+        """
+        Find packages. Each filter that is specified must match.
+        Args:
+            package_id (str, optional): The ID of the package
+            sha256 (str, optional): SHA-256 checksum of the package
+            start_datetime (str, optional): Keep the bundles whose time
+                                            window ends after this time
+            end_datetime (str, optional): Keep the bundles whose time
+                                          window starts before this time
+            duplicates (bool, optional): Keep only the packages saved more
+                                         than once, by ID or checksum
+            bundle_path (str, optional): Path of the bundle
+        Returns:
+            list: Packages as dict with the path and time window of their
+                  bundle, in bundle and offset order
+        """
+        conditions = []
+        params = []
+        for column, op, value in [
+            ("p.package_id", "=", package_id),
+            ("p.sha256", "=", sha256),
+            ("b.end_datetime", ">", start_datetime),
+            ("b.start_datetime", "<", end_datetime),
+            ("p.bundle_path", "=", bundle_path),
+        ]:
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        if duplicates:
+            conditions.append(
+                "(p.package_id IN (SELECT package_id FROM packages"
+                " GROUP BY package_id HAVING COUNT(*) > 1)"
+                " OR p.sha256 IN (SELECT sha256 FROM packages"
+                " GROUP BY sha256 HAVING COUNT(*) > 1))"
+            )
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        cursor = self.conn.execute(
+            "SELECT p.package_id, p.bundle_path, p.byte_offset, p.length,"
+            " p.sha256, p.created_datetime, b.start_datetime,"
+            " b.end_datetime FROM packages p"
+            f" JOIN bundles b ON b.path = p.bundle_path{where}"
+            " ORDER BY b.start_datetime, p.bundle_path, p.byte_offset",
+            params
+        )
+        return [
+            dict(zip(
+                ["id", "bundle", "offset", "length", "sha256",
+                 "createdDateTime", "startDateTime", "endDateTime"], row
+            ))
+            for row in cursor
+        ]
+
+
+def verify_bundle(catalog, bundle, checksums=False):
+    """
+    Check a cataloged bundle against its catalog entry.
+    Args:
+        catalog (BundleCatalog): Catalog of the bundle
+        bundle (dict): Bundle as returned by BundleCatalog.get_bundles
+        checksums (bool, optional): Whether to read the bundle and check
+                                    the SHA-256 checksum of each package.
+                                    Otherwise only the size is checked
+    Returns:
+        list: Problems found, empty if the bundle is valid
+    """
+    path = bundle["path"]
+    if not os.path.exists(path):
+        return ["bundle file missing"]
+    problems = []
+    size = os.path.getsize(path)
+    if size != bundle["size"]:
+        problems.append(f"size {size}, expected {bundle['size']}")
+    if not get_bundle_manifest_path(path).exists():
+        problems.append("manifest missing")
+    if not checksums:
+        return problems
+    with open(path, "rb") as fd:
+        for package in catalog.find_packages(bundle_path=path):
+            fd.seek(package["offset"])
+            checksum = hashlib.sha256()
+            remaining = package["length"]
+            while remaining:
+                chunk = fd.read(min(remaining, V1_DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                remaining -= len(chunk)
+            if remaining or checksum.hexdigest() != package["sha256"]:
+                problems.append(f"package {package['id']} checksum mismatch")
+    return problems
+
+
+def extract_package(package, output_path):
+    """
+    Copy a cataloged package out of its bundle.
+    Args:
+        package (dict): Package as returned by BundleCatalog.find_packages
+        output_path (Path): Path of the package file
+    """
+    with open(package["bundle"], "rb") as src, open(output_path, "wb") as fd:
+        src.seek(package["offset"])
+        remaining = package["length"]
+        while remaining:
+            chunk = src.read(min(remaining, V1_DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError(f"Bundle truncated: {package['bundle']}")
+            fd.write(chunk)
+            remaining -= len(chunk)
+
+
+# Keys of a telemetry record holding its subtype and its time. The first key
+# present in a record is used.
+RECORD_SUBTYPE_KEYS = ["subType", "dataSubType", "telemetryType"]
+RECORD_TIME_KEYS = ["eventTime", "eventTimeDT", "logReceivedTime", "timestamp"]
+
+
+def get_record_partition(record, default_subtype):
+    """
+    Get the partition of a telemetry record.
+    Args:
+        record (dict): Telemetry record
+        default_subtype (str): Subtype of the records without subtype key
+    Returns:
+        tuple: Subtype, date (YYYY-MM-DD) and hour (HH) of the record, the
+               date and hour being "unknown" when the time is missing
+    """
+    subtype = next(
+        (record[k] for k in RECORD_SUBTYPE_KEYS
+         if isinstance(record.get(k), str) and record[k]),
+        default_subtype
+    )
+    subtype = re.sub(r"[^A-Za-z0-9_.-]", "_", subtype)
+    value = next(
+        (record[k] for k in RECORD_TIME_KEYS if record.get(k) is not None),
+        None
+    )
+    try:
+        if isinstance(value, str) and not value.isdigit():
+            time_ = datetime.datetime.fromisoformat(
+                value.replace("Z", "+00:00")
+            )
+            if time_.tzinfo is None:
+                time_ = time_.replace(tzinfo=datetime.timezone.utc)
+        else:
+            value = float(value)
+            # epoch times in milliseconds
+            if value > 1e11:
+                value /= 1000
+            time_ = datetime.datetime.fromtimestamp(
+                value, tz=datetime.timezone.utc
+            )
+    except (TypeError, ValueError, OverflowError, OSError):
+        return subtype, "unknown", "unknown"
+    time_ = time_.astimezone(datetime.timezone.utc)
+    return subtype, time_.strftime("%Y-%m-%d"), time_.strftime("%H")
+
+
+class TelemetryPartitioner:
+    """
+    Routes the records of telemetry packages into Hive-style partitions
+    <path>/subtype=<subtype>/date=<YYYY-MM-DD>/hour=<HH>, so that consumers
+    read only the partitions they need. Each partition is written to
+    rolling gzip NDJSON segments. A segment is written to a .part file,
+    completed when it reaches segment_size bytes of records, and renamed
+    when commit is called once the bundle of the packages is saved, so
+    that consumers only see complete segments and a capture interrupted
+    before its bundle is saved does not partition the same packages twice
+    when it is resumed. The records of a
+    package are compressed to one gzip member per partition, appended to
+    the segments only once the whole package is decoded, so that a package
+    that cannot be decoded leaves no records. Packages can be added from
+    several threads.
+    """
+
+    # Size in bytes of the gzip members of a package kept in memory before
+    # they are spooled to a temporary file
+    SPOOL_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path, segment_size, default_subtype="unknown"):
+        """
+        Args:
+            path (str): Root directory of the partitions
+            segment_size (int): Size in bytes of uncompressed records after
+                                which a segment is renamed and a new one
+                                started
+            default_subtype (str, optional): Subtype of the records without
+                                             subtype key
+        """
+        self.path = pathlib.Path(path)
+        self.segment_size = segment_size
+        self.default_subtype = default_subtype
+        self.lock = threading.Lock()
+        self.segments = {}
+        # (.part path, path) of the completed segments not yet committed
+        self.completed = []
+        # segment names of different runs never collide
+        self.run_id = uuid.uuid4().hex[:8]
+        self.sequence = itertools.count()
+
+    def add_package(self, package_id, path):
+        """
+        Decode a package as a stream and write its records to their
+        partitions. Records that are not JSON objects are skipped.
+        Args:
+            package_id (str): Unique identifier for the package
+            path (Path): Path of the gzip package
+        """
+        # partition -> (spool file, gzip writer, size of the records)
+        members = {}
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as fd:
+                for line in fd:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    records = json.loads(line)
+                    if isinstance(records, dict):
+                        records = [records]
+                        lines = [line]
+                    elif isinstance(records, list):
+                        lines = [json.dumps(r) for r in records]
+                    else:
+                        continue
+                    for record, record_line in zip(records, lines):
+                        if not isinstance(record, dict):
+                            continue
+                        partition = get_record_partition(
+                            record, self.default_subtype
+                        )
+                        member = members.get(partition)
+                        if member is None:
+                            spool = tempfile.SpooledTemporaryFile(
+                                self.SPOOL_SIZE
+                            )
+                            member = members[partition] = [
+                                spool, gzip.GzipFile(fileobj=spool,
+                                                     mode="wb"), 0
+                            ]
+                        data = (record_line + "\n").encode("utf-8")
+                        member[1].write(data)
+                        member[2] += len(data)
+            for spool, writer, size in members.values():
+                writer.close()
+        except (OSError, EOFError, ValueError, zlib.error) as e:
+            # a package that cannot be decoded is still captured
+            print(f"Unable to partition package {package_id}: {e}")
+            for spool, writer, size in members.values():
+                spool.close()
+            return
+        try:
+            self.write(members)
+        finally:
+            for spool, writer, size in members.values():
+                spool.close()
+
+    def write(self, members):
+        with self.lock:
+            for partition, (spool, _, size) in members.items():
+                segment = self.segments.get(partition)
+                if segment is None:
+                    segment = self.open_segment(partition)
+                spool.seek(0)
+                shutil.copyfileobj(spool, segment[2])
+                segment[3] += size
+                if segment[3] >= self.segment_size:
+                    self.close_segment(partition)
+
+    def open_segment(self, partition):
+        subtype, date, hour = partition
+        path = self.path.joinpath(
+            f"subtype={subtype}", f"date={date}", f"hour={hour}",
+            f"part-"
+            f"{datetime.datetime.now(tz=datetime.timezone.utc):%Y%m%dT%H%M%SZ}"
+            f"-{self.run_id}-{next(self.sequence):06d}.ndjson.gz"
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(path.name + ".part")
+        # gzip members are concatenated, so that the segment is read as
+        # one stream
+        segment = [path, part_path, open(part_path, "wb"), 0]
+        self.segments[partition] = segment
+        return segment
+
+    def close_segment(self, partition):
+        path, part_path, fd, _ = self.segments.pop(partition)
+        fd.close()
+        self.completed.append((part_path, path))
+
+    def commit(self):
+        """
+        Complete the segments being written and rename the completed
+        segments, so that the records of the packages added so far can be
+        read. Called once the packages are saved to a bundle.
+        """
+        with self.lock:
+            for partition in list(self.segments):
+                self.close_segment(partition)
+            for part_path, path in self.completed:
+                os.replace(part_path, path)
+            self.completed.clear()
+
+    def close(self):
+        """
+        Delete the segments that are not committed, as their packages are
+        downloaded again by the next capture.
+        """
+        with self.lock:
+            for partition in list(self.segments):
+                self.close_segment(partition)
+            for part_path, _ in self.completed:
+                part_path.unlink(missing_ok=True)
+            self.completed.clear()
+
+
+def capture_bundle(
+    client, pipeline_id, items, bundle_path, start_time_str, end_time_str,
+    spool_path, pool, workers, catalog, on_package=None
+):
+    """
+    Download the packages of a time window into a bundle, write the
+    manifest of the bundle next to it and add the bundle to the catalog.
+    The bundle is written to a .part file, created with the first package
+    and renamed once complete. Packages already in the catalog, listed
+    again in a later time window, are skipped.
+    Args:
+        client (TmV1Client): API client
+        pipeline_id (str): Unique identifier for the data pipeline
+        items (iterable): Package descriptors of the time window
+        bundle_path (Path): Path of the bundle
+        start_time_str (str): Start of the time window
+        end_time_str (str): End of the time window
+        spool_path (Path): Directory the packages are downloaded to
+        pool (ThreadPoolExecutor): Download workers
+        workers (int): Number of workers of the pool
+        catalog (BundleCatalog): Catalog of the output directory
+        on_package (callable, optional): Called by the download workers
+                                         with the ID and the path of each
+                                         package
+    Returns:
+        int: Number of packages saved to the bundle, or None when
+             STOP_CAPTURING is set before the bundle is complete
+    """
+    created = {}
+    stopped = False
+
+    def iter_new_package_ids():
+        nonlocal stopped
+        for item in items:
+            if STOP_CAPTURING.is_set():
+                stopped = True
+                return
+            package_id = item["id"]
+            if package_id in created or catalog.has_package(package_id):
+                print(f"- skipped package already saved: {package_id}")
+                continue
+            created[package_id] = item.get("createdDateTime")
+            yield package_id
+        # the listing of the window is cut short when STOP_CAPTURING is set
+        stopped = STOP_CAPTURING.is_set()
+
+    part_path = bundle_path.with_name(bundle_path.name + ".part")
+    fd = None
+    packages = []
+    try:
+        for package_id, path, size, checksum in iter_packages(
+            client, pipeline_id, iter_new_package_ids(), spool_path, pool,
+            workers, on_package
+        ):
+            if stopped:
+                break
+            if fd is None:
+                fd = open(part_path, "wb")
+            packages.append({
+                "id": package_id,
+                "offset": fd.tell(),
+                "length": size,
+                "sha256": checksum,
+                "createdDateTime": created[package_id],
+            })
+            with open(path, "rb") as package:
+                shutil.copyfileobj(package, fd)
+            print(
+                f"- saved package: {package_id}, size={size}, "
+                f"sha256={checksum}"
+            )
+        if stopped:
+            return None
+        if fd is None:
+            return 0
+        bundle_size = fd.tell()
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        # an interrupted bundle is kept as a .part file without manifest
+        if fd is not None:
+            fd.close()
+    os.replace(part_path, bundle_path)
+    manifest = {
+        "bundle": bundle_path.name,
+        "pipelineId": pipeline_id,
+        "startDateTime": start_time_str,
+        "endDateTime": end_time_str,
+        "size": bundle_size,
+        "packages": packages,
+    }
+    write_bundle_manifest(bundle_path, manifest)
+    catalog.add_bundle(bundle_path, manifest)
+    return len(packages)
+
+
 def signal_int_handler(sig, frame):
     """
     Handler for SIGINT signal to stop continuous package retrieval.
@@ -359,12 +1142,85 @@ def signal_int_handler(sig, frame):
         frame: Current stack frame
     """
     print("stop capturing")
-    global CAPTURING
-    CAPTURING = False
+    STOP_CAPTURING.set()
+
+
+# event set to stop continuous-get-packages mode
+STOP_CAPTURING = threading.Event()
+
+
+class WindowScheduler:
+    """
+    Lists the packages of consecutive time windows of interval seconds,
+    each as soon as its window ends. The window ends are converted to
+    deadlines on the monotonic clock, so that they do not drift with the
+    processing time or with changes of the system clock. Packages are
+    listed in a background thread and handed over page by page, so that
+    downloads start with the first page and the next window is listed
+    while the packages of the current window are downloaded. Waits end as
+    soon as STOP_CAPTURING is set.
+    """
+
+    def __init__(self, list_packages, start_datetime, interval):
+        """
+        Args:
+            list_packages (callable): Called with the start and end
+                                      datetime of a window, returns an
+                                      iterable of the packages of the
+                                      window
+            start_datetime (datetime): Start of the first window
+            interval (int): Length of the windows in seconds
+        """
+        self.list_packages = list_packages
+        self.interval = datetime.timedelta(seconds=interval)
+        self.windows = queue.Queue()
+        self.lister = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.lister.submit(self.fetch, start_datetime)
+
+    def fetch(self, start_datetime):
+        end_datetime = start_datetime + self.interval
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        deadline = time.monotonic() + (end_datetime - now).total_seconds()
+        if STOP_CAPTURING.wait(max(0, deadline - time.monotonic())):
+            self.windows.put(None)
+            return
+        items = queue.Queue()
+        self.windows.put(
+            (start_datetime, end_datetime, self.iter_queue(items))
+        )
+        try:
+            # the listing ends between two pages once STOP_CAPTURING is set
+            for item in self.list_packages(start_datetime, end_datetime):
+                if STOP_CAPTURING.is_set():
+                    break
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        else:
+            items.put((None, None))
 
+    @staticmethod
+    def iter_queue(items):
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is None:
+                return
+            yield item
 
-# flag to indicate if continue in continuous-get-packages mode
-CAPTURING = True
+    def __iter__(self):
+        while True:
+            window = self.windows.get()
+            if window is None:
+                return
+            # runs once the listing of this window is complete
+            self.lister.submit(self.fetch, window[1])
+            yield window
+
+    def close(self):
+        STOP_CAPTURING.set()
+        self.lister.shutdown(wait=True)
 
 
 def main(args):
@@ -374,6 +1230,61 @@ def main(args):
     Args:
         args: Parsed command line arguments
     """
+    if args.request in ["verify-catalog", "query-catalog"] and (
+        not os.path.exists(args.catalog)
+    ):
+        print(f"Catalog not found: {args.catalog}")
+        sys.exit(1)
+    if args.request == "verify-catalog":
+        print(
+            f"request: {args.request}, "
+            f"args: catalog={args.catalog}, checksums={args.checksums}"
+        )
+        catalog = BundleCatalog(args.catalog)
+        try:
+            bundles = catalog.get_bundles()
+            invalid_count = 0
+            for bundle in bundles:
+                problems = verify_bundle(catalog, bundle, args.checksums)
+                if problems:
+                    invalid_count += 1
+                    print(f"- invalid bundle: {bundle['path']}")
+                    for problem in problems:
+                        print(f"  - {problem}")
+        finally:
+            catalog.close()
+        print(f"Verified {len(bundles)} bundles: {invalid_count} invalid")
+        if invalid_count:
+            sys.exit(1)
+        return
+    if args.request == "query-catalog":
+        print(
+            f"request: {args.request}, "
+            f"args: catalog={args.catalog}, package_id={args.package_id}, "
+            f"sha256={args.sha256}, start_datetime={args.start_datetime}, "
+            f"end_datetime={args.end_datetime}, "
+            f"duplicates={args.duplicates}, extract_dir={args.extract_dir}"
+        )
+        catalog = BundleCatalog(args.catalog)
+        try:
+            packages = catalog.find_packages(
+                package_id=args.package_id,
+                sha256=args.sha256,
+                start_datetime=args.start_datetime,
+                end_datetime=args.end_datetime,
+                duplicates=args.duplicates,
+            )
+        finally:
+            catalog.close()
+        print(json.dumps(packages, indent=2))
+        if args.extract_dir:
+            extract_path = pathlib.Path(args.extract_dir)
+            extract_path.mkdir(parents=True, exist_ok=True)
+            for package in packages:
+                package_path = extract_path.joinpath(f"{package['id']}.gz")
+                extract_package(package, package_path)
+                print(f"- extracted package: {package_path}")
+        return
     url = args.v1_url
     token = args.v1_token
     if args.token_file and not token:
@@ -383,7 +1294,9 @@ def main(args):
         except FileNotFoundError:
             print(f"Token not found: {args.token_file}")
             sys.exit(1)
-    client = TmV1Client(token, url)
+    client = TmV1Client(
+        token, url, getattr(args, "workers", V1_DOWNLOAD_WORKERS)
+    )
     if args.request == "register":
         print(
             f"request: {args.request}, "
@@ -428,6 +1341,26 @@ def main(args):
         )
         result = client.delete_datapipeline(pipeline_id_list=args.pipeline_id)
         print(json.dumps(result, indent=2))
+    elif args.request == "list-packages" and args.ndjson:
+        # packages are written to stdout as they are received, one JSON
+        # object per line, and the other messages to stderr
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            print(
+                f"request: {args.request}, "
+                f"args: pipeline_id={args.pipeline_id}, "
+                f"start_datetime={args.start_datetime}, "
+                f"end_datetime={args.end_datetime}, "
+                f"top={args.top}, "
+            )
+            for item in client.iter_datapipeline_packages(
+                pipeline_id=args.pipeline_id,
+                start_datetime=args.start_datetime,
+                end_datetime=args.end_datetime,
+                top=args.top
+            ):
+                stdout.write(json.dumps(item) + "\n")
+                stdout.flush()
     elif args.request == "list-packages":
         print(
             f"request: {args.request}, "
@@ -451,64 +1384,83 @@ def main(args):
         )
         output_path = pathlib.Path(args.output)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        result = client.get_datapipeline_package(
-            pipeline_id=args.pipeline_id, package_id=args.package_id
+        size, checksum = client.download_datapipeline_package(
+            pipeline_id=args.pipeline_id, package_id=args.package_id,
+            output_path=output_path
         )
-        with open(output_path, "wb") as fd:
-            fd.write(result)
+        print(f"saved package: {output_path}, size={size}, sha256={checksum}")
     elif args.request == "continuous-get-packages":
         output_path = pathlib.Path(args.output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
+        # packages are downloaded to the spool directory, and copied to
+        # the bundle in the order they are listed
+        spool_path = output_path.joinpath(".packages")
+        spool_path.mkdir(exist_ok=True)
         signal.signal(signal.SIGINT, signal_int_handler)
         interval = args.interval
         pipeline_id = args.pipeline_id
         start_datetime = datetime.datetime.now(tz=datetime.timezone.utc)
         end_datetime = start_datetime + datetime.timedelta(seconds=interval)
-        process_start = time.time()
         print(
             "start capturing..., next request is around: ",
             end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
         )
-        while CAPTURING:
-            if time.time() - process_start > interval:
-                # Get all packages for the current time interval using
-                # get_items (via get_datapipeline_packages)
-                packages_response = client.get_datapipeline_packages(
-                    pipeline_id=pipeline_id,
-                    start_datetime=(
-                        start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-                    ),
-                    end_datetime=(
-                        end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-                    ),
-                    top=args.top
-                )
+
+        def list_packages(start_datetime, end_datetime):
+            # Get all packages for the time interval using get_items (via
+            # get_datapipeline_packages)
+            return client.iter_datapipeline_packages(
+                pipeline_id=pipeline_id,
+                start_datetime=start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                end_datetime=end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                top=args.top
+            )
+
+        scheduler = WindowScheduler(list_packages, start_datetime, interval)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        catalog = BundleCatalog(
+            args.catalog or output_path.joinpath("catalog.db")
+        )
+        partitioner = None
+        on_package = None
+        if args.partition_dir:
+            # records without subtype key belong to the subtype of the
+            # pipeline, when it has only one
+            sub_types = client.get_datapipeline(pipeline_id).get("subType")
+            sub_types = sub_types or []
+            partitioner = TelemetryPartitioner(
+                args.partition_dir, args.segment_size,
+                sub_types[0] if len(sub_types) == 1 and sub_types[0] != "all"
+                else "unknown"
+            )
+            # packages are partitioned by the download workers
+            on_package = partitioner.add_package
+        try:
+            for start_datetime, end_datetime, items in scheduler:
                 # Create a bundle file for this time interval
-                bundle_name = (
-                    f"bundle-"
-                    f"{start_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')}"
-                    f"-{end_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')}.gz"
-                )
+                start_time_str = start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+                end_time_str = end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+                bundle_name = f"bundle-{start_time_str}-{end_time_str}.gz"
                 bundle_path = output_path.joinpath(bundle_name)
-                # Process all packages that were retrieved
-                if packages_response["items"]:
-                    with open(bundle_path, "wb") as fd:
-                        for item in packages_response["items"]:
-                            package_id = item["id"]
-                            package = client.get_datapipeline_package(
-                                pipeline_id=pipeline_id,
-                                package_id=package_id
-                            )
-                            fd.write(package)
-                            print(f"- saved package: {package_id}")
+                # Process the packages as they are listed, and create the
+                # bundle with the first one
+                package_count = capture_bundle(
+                    client, pipeline_id, items, bundle_path, start_time_str,
+                    end_time_str, spool_path, pool, args.workers, catalog,
+                    on_package
+                )
+                if package_count is None:
+                    print(f"capture stopped before {bundle_name} was complete")
+                    break
+                # the records are published once their bundle is saved
+                if partitioner is not None:
+                    partitioner.commit()
+                if package_count:
                     print(
                         f'captured packages until: '
                         f'{end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")}'
                     )
-                    print(
-                        f"  - captured package count: "
-                        f"{len(packages_response['items'])}"
-                    )
+                    print(f"  - captured package count: {package_count}")
                     print(f"  - bundle path: {bundle_path}")
                 else:
                     print(
@@ -516,17 +1468,17 @@ def main(args):
                         f"{start_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')} "
                         f"to {end_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')}"
                     )
-                # Update the time window for the next iteration
-                start_datetime = end_datetime
-                end_datetime = (
-                    start_datetime + datetime.timedelta(seconds=interval)
-                )
-                process_start = time.time()
                 print(
                     "  - next request is around: ",
-                    end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    (end_datetime + datetime.timedelta(seconds=interval))
+                    .strftime("%Y-%m-%dT%H:%M:%SZ"),
                 )
-            time.sleep(3)
+        finally:
+            scheduler.close()
+            pool.shutdown(wait=True, cancel_futures=True)
+            catalog.close()
+            if partitioner is not None:
+                partitioner.close()
         print("Capture process terminated")
 
 
@@ -607,6 +1559,10 @@ if __name__ == "__main__":
         "-t", "--top", type=int,
         default=500, choices=TmV1Client.packages_top_choices,
         help="Maximum number of results to return")
+    list_packages_parser.add_argument(
+        "--ndjson", action="store_true",
+        help="Write each package to stdout as one JSON line as soon as "
+             "its page is received")
     get_package_parser = request_parsers.add_parser("get-package")
     get_package_parser.add_argument("pipeline_id", help="Pipeline ID")
     get_package_parser.add_argument("package_id", help="Package ID")
@@ -629,6 +1585,56 @@ if __name__ == "__main__":
         "output_dir",
         help="Output directory path"
     )
+    cont_get_package_parser.add_argument(
+        "-w", "--workers", type=int, default=V1_DOWNLOAD_WORKERS,
+        help="Number of packages downloaded at the same time")
+    cont_get_package_parser.add_argument(
+        "-c", "--catalog",
+        help="SQLite catalog of the captured bundles and packages. "
+             "Default: <output_dir>/catalog.db")
+    cont_get_package_parser.add_argument(
+        "-P", "--partition-dir",
+        help="Also write the records of the packages to partitions "
+             "<partition_dir>/subtype=<subtype>/date=<date>/hour=<hour>")
+    cont_get_package_parser.add_argument(
+        "--segment-size", type=int, default=V1_SEGMENT_SIZE,
+        help="Size in bytes of uncompressed records after which a "
+             "partition segment is completed and a new one started")
+    verify_catalog_parser = request_parsers.add_parser(
+        "verify-catalog",
+        help="Check that the cataloged bundles are complete"
+    )
+    verify_catalog_parser.add_argument(
+        "catalog", help="Catalog file path")
+    verify_catalog_parser.add_argument(
+        "--checksums", action="store_true",
+        help="Read the bundles and check the SHA-256 checksum of each "
+             "package instead of the bundle size only")
+    query_catalog_parser = request_parsers.add_parser(
+        "query-catalog",
+        help="Find cataloged packages without reading the bundles"
+    )
+    query_catalog_parser.add_argument(
+        "catalog", help="Catalog file path")
+    query_catalog_parser.add_argument(
+        "-p", "--package-id", help="Package ID")
+    query_catalog_parser.add_argument(
+        "--sha256", help="SHA-256 checksum of the package")
+    query_catalog_parser.add_argument(
+        "-s", "--start-datetime",
+        help="Keep the bundles whose time window ends after this time. "
+             "Ex: 2022-09-15T14:10:00Z")
+    query_catalog_parser.add_argument(
+        "-e", "--end-datetime",
+        help="Keep the bundles whose time window starts before this time. "
+             "Ex: 2022-09-15T14:30:00Z")
+    query_catalog_parser.add_argument(
+        "-d", "--duplicates", action="store_true",
+        help="Keep the packages saved more than once, by ID or checksum")
+    query_catalog_parser.add_argument(
+        "-x", "--extract-dir",
+        help="Copy the packages found out of their bundles to this "
+             "directory")
     _args = parser.parse_args()
 
     main(_args)
@@ -4,6 +4,7 @@ import ipaddress
 import datetime
 import time
 import argparse
+import concurrent.futures
 
 import requests
 
@@ -20,6 +21,10 @@ V1_UA = os.environ.get('TMV1_UA', 'Trend Vision One API Cookbook '
                        f'({os.path.basename(__file__)})')
 V1_WAIT_TASK_INTERVAL = int(os.environ.get('TMV1_WAIT_TASK_INTERVAL', 10))
 V1_WAIT_TASK_RETRY = int(os.environ.get('TMV1_WAIT_TASK_RETRY', 12))
+# Maximum number of IDs in the filter of one task list request, and maximum
+# number of requests sent concurrently
+V1_FILTER_CHUNK_SIZE = int(os.environ.get('TMV1_FILTER_CHUNK_SIZE', 50))
+V1_MAX_WORKERS = int(os.environ.get('TMV1_MAX_WORKERS', 4))
 
 
 def is_container(v):
@@ -165,6 +170,27 @@ class TmV1Client:
             next_link = r['nextLink']
         return items
 
+    def get_items_by_ids(self, path, ids, name='id', **kwargs):
+        ids = list(ids)
+        chunks = [ids[i:i+V1_FILTER_CHUNK_SIZE]
+                  for i in range(0, len(ids), V1_FILTER_CHUNK_SIZE)]
+
+        def get_chunk(chunk):
+            params = dict(kwargs.get('params', {}))
+            params['filter'] = get_filter_arg(name, chunk)
+            return self.get_items(path, **{
+                **kwargs, 'params': params,
+                'headers': dict(kwargs.get('headers', {}))
+            })
+
+        items = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(V1_MAX_WORKERS, len(chunks)))
+        ) as executor:
+            for r in executor.map(get_chunk, chunks):
+                items.update((item[name], item) for item in r)
+        return [items[v] for v in ids if v in items]
+
     def get_from_post_response(self, status_code, headers, body):
         if (201 == status_code) and ('Location' in headers):
             return self.get(headers['Location'])
@@ -290,10 +316,9 @@ class TmV1Client:
                                   json=request)
 
     def get_response_tasks(self, ids=None):
-        params = {}
         if ids is not None:
-            params['filter'] = get_filter_arg('id', ids)
-        return self.get_items('/v3.0/response/tasks', params=params)
+            return self.get_items_by_ids('/v3.0/response/tasks', ids)
+        return self.get_items('/v3.0/response/tasks')
 
 
 def fetch_new_workbench_alerts(v1, start, end):
@@ -374,10 +399,11 @@ def wait_response_tasks(v1, tasks):
                f'Waiting interval (seconds): {V1_WAIT_TASK_INTERVAL}; '
                f'Number of intervals: {count}.'))
         time.sleep(V1_WAIT_TASK_INTERVAL)
-        response = v1.get_response_tasks([tasks[i]['id']
-                                         for i in running_task_indexes])
-        for i, r in enumerate(response):
-            tasks[running_task_indexes[i]].update(r)
+        response = dict((r['id'], r) for r in v1.get_response_tasks(
+            [tasks[i]['id'] for i in running_task_indexes]
+        ))
+        for i in running_task_indexes:
+            tasks[i].update(response.get(tasks[i]['id'], {}))
     finished = not running_task_indexes
     if not finished:
         print('Tasks not finished')
@@ -1,7 +1,20 @@
 import os
+import io
+import re
 import sys
+import csv
+import json
 import time
+import codecs
+import shutil
+import sqlite3
+import hashlib
+import datetime
+import tempfile
 import argparse
+import concurrent.futures
+import ipaddress
+import urllib.parse
 
 import requests
 
@@ -18,6 +31,18 @@ V1_UA = os.environ.get('TMV1_UA', 'Trend Vision One API Cookbook '
                        f'({os.path.basename(__file__)})')
 V1_WAIT_TASK_INTERVAL = int(os.environ.get('TMV1_WAIT_TASK_INTERVAL', 10))
 V1_WAIT_TASK_RETRY = int(os.environ.get('TMV1_WAIT_TASK_RETRY', 12))
+# Maximum number of IDs in the filter of one task list request, and maximum
+# number of requests sent concurrently
+V1_FILTER_CHUNK_SIZE = int(os.environ.get('TMV1_FILTER_CHUNK_SIZE', 50))
+V1_MAX_WORKERS = int(os.environ.get('TMV1_MAX_WORKERS', 4))
+# Local index of swept indicators used by the delta mode. Indicators swept
+# within V1_SWEEP_TTL seconds are not imported again.
+#   default: "" (delta mode disabled)
+V1_INDICATOR_INDEX = os.environ.get('TMV1_INDICATOR_INDEX', '')
+V1_SWEEP_TTL = int(os.environ.get('TMV1_SWEEP_TTL', 86400))
+# SQLite file that accumulates the matched indicators of every sweep run
+#   default: "" (sweeping results are only saved as JSON files)
+V1_HIT_STORE = os.environ.get('TMV1_HIT_STORE', '')
 
 
 def is_container(v):
@@ -48,6 +73,420 @@ def get_filter_arg(name, value, enclose="'", equal='eq'):
     return param
 
 
+# STIX object paths mapped to the indicator types of custom intelligence
+STIX_PATTERN_TYPES = {
+    'ipv4-addr:value': 'ip',
+    'ipv6-addr:value': 'ip',
+    'domain-name:value': 'domain',
+    'url:value': 'url',
+    'email-addr:value': 'senderMailAddress',
+    "file:hashes.'sha-1'": 'fileSha1',
+    'file:hashes.sha1': 'fileSha1',
+    "file:hashes.'sha-256'": 'fileSha256',
+    'file:hashes.sha256': 'fileSha256',
+}
+STIX_PATTERN_RE = re.compile(
+    r"^\[\s*([\w\-]+:[\w\-.']+)\s*=\s*'((?:[^'\\]|\\.)*)'\s*\]$"
+)
+STIX_OBJECTS_RE = re.compile(r'"objects"\s*:\s*\[')
+# CSV header names of the indicator type and value columns
+CSV_TYPE_COLUMNS = ['type', 'indicator type', 'object type', 'objecttype']
+CSV_VALUE_COLUMNS = ['value', 'indicator', 'object', 'objectvalue']
+DOMAIN_RE = re.compile(
+    r'^(?=.{1,253}$)(\*\.)?([a-z0-9_]([a-z0-9\-_]{0,61}[a-z0-9])?\.)+'
+    r'[a-z0-9\-]{2,63}$'
+)
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+HEX_RE = re.compile(r'^[0-9a-f]+$')
+
+
+def is_ipaddress(v):
+    try:
+        ipaddress.ip_address(v)
+    except ValueError:
+        return False
+    return True
+
+
+def is_url(v):
+    parts = urllib.parse.urlsplit(v)
+    return bool(parts.scheme and parts.netloc)
+
+
+def is_hex(v, length):
+    return (length == len(v)) and (HEX_RE.match(v) is not None)
+
+
+INDICATOR_VALIDATORS = {
+    'ip': is_ipaddress,
+    'domain': lambda v: DOMAIN_RE.match(v) is not None,
+    'url': is_url,
+    'senderMailAddress': lambda v: EMAIL_RE.match(v) is not None,
+    'fileSha1': lambda v: is_hex(v, 40),
+    'fileSha256': lambda v: is_hex(v, 64),
+}
+INDICATOR_TYPES = dict((t.lower(), t) for t in INDICATOR_VALIDATORS)
+
+
+def normalize_indicator(type_, value):
+    type_ = INDICATOR_TYPES.get(type_.strip().lower(), type_.strip())
+    value = value.strip()
+    if 'url' == type_:
+        parts = urllib.parse.urlsplit(value)
+        value = urllib.parse.urlunsplit(
+            parts._replace(scheme=parts.scheme.lower(),
+                           netloc=parts.netloc.lower())
+        )
+    else:
+        value = value.lower()
+    return type_, value
+
+
+def get_indicator_fingerprint(type_, value):
+    type_, value = normalize_indicator(type_, value)
+    return hashlib.sha256(f'{type_.lower()}\0{value}'.encode()).hexdigest()
+
+
+def parse_stix_pattern(pattern):
+    m = STIX_PATTERN_RE.match(pattern.strip())
+    if m is None:
+        return None
+    type_ = STIX_PATTERN_TYPES.get(m.group(1).lower())
+    if type_ is None:
+        return None
+    return type_, m.group(2)
+
+
+def get_csv_columns(header):
+    names = [h.strip().lower() for h in header]
+    type_col = next((names.index(c) for c in CSV_TYPE_COLUMNS
+                     if c in names), 0)
+    value_col = next((names.index(c) for c in CSV_VALUE_COLUMNS
+                      if c in names), 1)
+    return type_col, value_col
+
+
+# Iterates over (line, object) of a STIX bundle without loading the whole
+# file. The text before and after the "objects" array is kept in prefix and
+# suffix so that the bundle can be rewritten.
+class StixObjectReader:
+    def __init__(self, file_obj, chunk_size=1 << 16):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.prefix = ''
+        self.suffix = ''
+
+    def read(self):
+        chunk = self.file_obj.read(self.chunk_size)
+        return self.decoder.decode(chunk, final=not chunk), not chunk
+
+    def __iter__(self):
+        json_decoder = json.JSONDecoder()
+        buf, eof = '', False
+        while True:
+            m = STIX_OBJECTS_RE.search(buf)
+            if m is not None:
+                break
+            if eof:
+                raise ValueError('Line 1: STIX bundle "objects" not found')
+            text, eof = self.read()
+            buf += text
+        self.prefix = buf[:m.end()]
+        buf = buf[m.end():]
+        line = self.prefix.count('\n') + 1
+        while True:
+            stripped = buf.lstrip(' \t\r\n,')
+            line += buf[:len(buf) - len(stripped)].count('\n')
+            buf = stripped
+            if buf.startswith(']'):
+                break
+            try:
+                obj, end = json_decoder.raw_decode(buf)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f'Line {line + e.lineno - 1}: '
+                                     f'{e.msg}') from e
+                text, eof = self.read()
+                buf += text
+                continue
+            if not isinstance(obj, dict):
+                raise ValueError(f'Line {line}: STIX object expected')
+            yield line, obj
+            line += buf[:end].count('\n')
+            buf = buf[end:]
+        while not eof:
+            text, eof = self.read()
+            buf += text
+        self.suffix = buf
+
+
+def iter_stix_indicators(file_obj):
+    for line, o in StixObjectReader(file_obj):
+        if 'indicator' != o.get('type'):
+            continue
+        pattern = o.get('pattern')
+        if not (isinstance(pattern, str) and pattern.strip()):
+            yield o.get('id'), line, None, 'Missing indicator pattern'
+            continue
+        pattern_type = o.get('pattern_type', 'stix')
+        indicator = None
+        if 'stix' == pattern_type:
+            indicator = parse_stix_pattern(pattern)
+        if indicator is None:
+            # patterns that are not one comparison of a supported object
+            # type are passed through without validation
+            indicator = (f'{pattern_type} pattern', pattern)
+        yield o.get('id'), line, indicator, None
+
+
+def iter_csv_rows(file_obj):
+    text = io.TextIOWrapper(file_obj, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(text)
+        for row in reader:
+            yield reader.line_num, row
+    finally:
+        text.detach()
+
+
+def iter_csv_indicators(file_obj):
+    columns = None
+    for line, row in iter_csv_rows(file_obj):
+        if columns is None:
+            columns = get_csv_columns(row)
+            continue
+        if not any(c.strip() for c in row):
+            continue
+        if len(row) <= max(columns):
+            yield line, line, None, 'Missing indicator type or value'
+            continue
+        yield line, line, (row[columns[0]], row[columns[1]]), None
+
+
+# Yields (key, line, (type, value), error) for each indicator. The key is
+# the STIX object id or the CSV line number.
+def iter_indicators(content_type, file_obj):
+    if 'stix' == content_type:
+        return iter_stix_indicators(file_obj)
+    return iter_csv_indicators(file_obj)
+
+
+# Indicators of a type without validator are kept as they are, and only
+# malformed indicators are reported as errors.
+def validate_intelligence_file(content_type, file_obj):
+    fingerprints = {}
+    seen = set()
+    errors = []
+    duplicate_count = 0
+    unsupported_count = 0
+    file_obj.seek(0)
+    try:
+        for key, line, indicator, error in iter_indicators(content_type,
+                                                           file_obj):
+            if error is None:
+                type_, value = normalize_indicator(*indicator)
+                validator = INDICATOR_VALIDATORS.get(type_)
+                if validator is None:
+                    unsupported_count += 1
+                elif not validator(value):
+                    error = f'Invalid {type_} value: {value}'
+            if error is not None:
+                errors.append((line, error))
+                continue
+            fingerprint = get_indicator_fingerprint(type_, value)
+            if fingerprint in seen:
+                duplicate_count += 1
+                continue
+            seen.add(fingerprint)
+            fingerprints[key] = fingerprint
+    except ValueError as e:
+        errors.append((None, str(e)))
+    return fingerprints, errors, duplicate_count, unsupported_count
+
+
+def write_intelligence_file(content_type, file_obj, keys):
+    out = tempfile.TemporaryFile()
+    file_obj.seek(0)
+    if 'stix' == content_type:
+        removed = set(o.get('id') for _, o in StixObjectReader(file_obj)
+                      if ('indicator' == o.get('type')) and
+                      (o.get('id') not in keys))
+        file_obj.seek(0)
+        reader = StixObjectReader(file_obj)
+        objects = (o for _, o in reader
+                   if not ((o.get('id') in removed) or
+                           (o.get('source_ref') in removed) or
+                           (o.get('target_ref') in removed) or
+                           (o.get('sighting_of_ref') in removed)))
+        first = next(objects, None)
+        out.write(reader.prefix.encode())
+        if first is not None:
+            out.write(json.dumps(first).encode())
+        for o in objects:
+            out.write((', ' + json.dumps(o)).encode())
+        out.write(reader.suffix.encode())
+    else:
+        text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerows(row for line, row in iter_csv_rows(file_obj)
+                         if (1 == line) or (line in keys))
+        text.detach()
+    out.seek(0)
+    return out
+
+
+class IndicatorIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS indicators ('
+                          'fingerprint TEXT PRIMARY KEY,'
+                          ' last_swept REAL NOT NULL)')
+
+    def close(self):
+        self.conn.close()
+
+    def get_due(self, fingerprints, ttl, now=None):
+        now = time.time() if now is None else now
+        fingerprints = list(set(fingerprints))
+        fresh = set()
+        # stay within the default host parameter limit of SQLite
+        for i in range(0, len(fingerprints), 500):
+            chunk = fingerprints[i:i+500]
+            cursor = self.conn.execute(
+                'SELECT fingerprint FROM indicators WHERE fingerprint IN'
+                f' ({",".join("?" * len(chunk))}) AND last_swept > ?',
+                [*chunk, now - ttl]
+            )
+            fresh.update(f for (f,) in cursor)
+        return set(fingerprints) - fresh
+
+    def mark_swept(self, fingerprints, now=None):
+        now = time.time() if now is None else now
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO indicators (fingerprint, last_swept)'
+                ' VALUES (?, ?) ON CONFLICT(fingerprint)'
+                ' DO UPDATE SET last_swept = excluded.last_swept',
+                [(f, now) for f in set(fingerprints)]
+            )
+
+
+def select_due_indicators(index, fingerprints, ttl):
+    due = index.get_due(fingerprints.values(), ttl)
+    return dict((k, f) for k, f in fingerprints.items() if f in due)
+
+
+# SQLite columns of the matched indicators counted by each --group-by value
+HIT_GROUP_COLUMNS = {
+    'indicator': 'indicator',
+    'endpoint': 'endpoint',
+    'report': 'report_id',
+}
+
+
+def get_hit_value(d, key):
+    v = d.get(key)
+    return str(v) if isinstance(v, (str, int, float)) else None
+
+
+# Yields (indicator, endpoint, event_time) for each log matched by a
+# sweeping task. The result lists each matched indicator pattern under
+# "matchedIndicatorPatterns" with its logs under "matchedLogs". Patterns
+# without matched logs are yielded with endpoint None.
+def iter_sweep_hits(result):
+    if not isinstance(result, dict):
+        return
+    for matched in result.get('matchedIndicatorPatterns') or []:
+        if not isinstance(matched, dict):
+            continue
+        pattern = get_hit_value(matched, 'pattern')
+        logs = [log for log in matched.get('matchedLogs') or []
+                if isinstance(log, dict)]
+        if not logs:
+            yield pattern, None, None
+        for log in logs:
+            yield (pattern, get_hit_value(log, 'endpointHostName'),
+                   get_hit_value(log, 'eventTime'))
+
+
+def get_datetime_arg(s):
+    d = datetime.datetime.fromisoformat(s.replace('Z', '+00:00'))
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=datetime.timezone.utc)
+    return d.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class HitStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sweep_hits ('
+                              'swept_at TEXT NOT NULL,'
+                              ' report_id TEXT NOT NULL,'
+                              ' task_id TEXT,'
+                              ' indicator TEXT,'
+                              ' endpoint TEXT,'
+                              ' event_time TEXT,'
+                              ' file_name TEXT)')
+            for column in ['swept_at', 'indicator', 'endpoint', 'report_id']:
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS sweep_hits_{column}'
+                    f' ON sweep_hits ({column}, swept_at)'
+                )
+
+    def close(self):
+        self.conn.close()
+
+    def ingest(self, task, result, file_name=None, swept_at=None):
+        swept_at = swept_at or get_datetime_arg(
+            task.get('lastActionDateTime') or
+            datetime.datetime.now(datetime.timezone.utc).isoformat()
+        )
+        rows = [(swept_at, task['reportId'], task.get('id'), indicator,
+                 endpoint, event_time, file_name)
+                for indicator, endpoint, event_time in iter_sweep_hits(result)]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO sweep_hits (swept_at, report_id, task_id,'
+                ' indicator, endpoint, event_time, file_name)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+        return len(rows)
+
+    def query(self, since=None, until=None, indicator=None, endpoint=None,
+              report_id=None, group_by=None):
+        conditions = []
+        params = []
+        for column, op, value in [('swept_at', '>=', since),
+                                  ('swept_at', '<', until),
+                                  ('indicator', '=', indicator),
+                                  ('endpoint', '=', endpoint),
+                                  ('report_id', '=', report_id)]:
+            if value is not None:
+                conditions.append(f'{column} {op} ?')
+                params.append(value)
+        where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        if group_by is None:
+            cursor = self.conn.execute(
+                'SELECT swept_at, report_id, task_id, indicator, endpoint,'
+                f' event_time, file_name FROM sweep_hits{where}'
+                ' ORDER BY swept_at', params
+            )
+        else:
+            column = HIT_GROUP_COLUMNS[group_by]
+            cursor = self.conn.execute(
+                f'SELECT {column}, COUNT(*) AS hits,'
+                ' MIN(swept_at) AS first_swept_at,'
+                ' MAX(swept_at) AS last_swept_at'
+                f' FROM sweep_hits{where} GROUP BY {column}'
+                ' ORDER BY hits DESC', params
+            )
+        names = [d[0] for d in cursor.description]
+        for row in cursor:
+            yield dict(zip(names, row))
+
+
 class TmV1Client:
     base_url_default = V1_URL
     intelligence_report_content_types = {
@@ -111,6 +550,27 @@ class TmV1Client:
             next_link = r['nextLink']
         return items
 
+    def get_items_by_ids(self, path, ids, name='id', **kwargs):
+        ids = list(ids)
+        chunks = [ids[i:i+V1_FILTER_CHUNK_SIZE]
+                  for i in range(0, len(ids), V1_FILTER_CHUNK_SIZE)]
+
+        def get_chunk(chunk):
+            params = dict(kwargs.get('params', {}))
+            params['filter'] = get_filter_arg(name, chunk)
+            return self.get_items(path, **{
+                **kwargs, 'params': params,
+                'headers': dict(kwargs.get('headers', {}))
+            })
+
+        items = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(V1_MAX_WORKERS, len(chunks)))
+        ) as executor:
+            for r in executor.map(get_chunk, chunks):
+                items.update((item[name], item) for item in r)
+        return [items[v] for v in ids if v in items]
+
     def get_from_post_response(self, status_code, headers, body):
         if (201 == status_code) and ('Location' in headers):
             return self.get(headers['Location'])
@@ -173,10 +633,9 @@ class TmV1Client:
         )
 
     def get_threatintel_tasks(self, ids=None):
-        params = {}
         if ids is not None:
-            params['filter'] = get_filter_arg('id', ids)
-        return self.get_items('/v3.0/threatintel/tasks', params=params)
+            return self.get_items_by_ids('/v3.0/threatintel/tasks', ids)
+        return self.get_items('/v3.0/threatintel/tasks')
 
 
 def wait_threatintel_tasks(v1, tasks):
@@ -195,10 +654,11 @@ def wait_threatintel_tasks(v1, tasks):
                f'Waiting interval (seconds): {V1_WAIT_TASK_INTERVAL}; '
                f'Number of intervals: {count}.'))
         time.sleep(V1_WAIT_TASK_INTERVAL)
-        response = v1.get_threatintel_tasks([tasks[i]['id']
-                                            for i in running_task_indexes])
-        for i, r in enumerate(response):
-            tasks[running_task_indexes[i]].update(r)
+        response = dict((r['id'], r) for r in v1.get_threatintel_tasks(
+            [tasks[i]['id'] for i in running_task_indexes]
+        ))
+        for i in running_task_indexes:
+            tasks[i].update(response.get(tasks[i]['id'], {}))
     finished = not running_task_indexes
     return finished
 
@@ -255,7 +715,29 @@ def import_and_sweep(v1, infile, name, content_type, report_name):
     return r
 
 
-def main(v1_token, v1_url, content_type, infile, name, report_name):
+def query_hits(store, since=None, until=None, indicator=None, endpoint=None,
+               report_id=None, group_by=None):
+    if not store:
+        raise ValueError('store must be specified for query')
+    hit_store = HitStore(store)
+    try:
+        for r in hit_store.query(
+            since=since and get_datetime_arg(since),
+            until=until and get_datetime_arg(until),
+            indicator=indicator, endpoint=endpoint, report_id=report_id,
+            group_by=group_by
+        ):
+            print(json.dumps(r))
+    finally:
+        hit_store.close()
+
+
+def main(v1_token, v1_url, content_type, infile=None, name=None,
+         report_name=None, index=None, ttl=V1_SWEEP_TTL, skip_invalid=False,
+         store=None, **kwargs):
+    if 'query' == content_type:
+        query_hits(store, **kwargs)
+        return
     if infile.isatty():
         raise ValueError('sys.stdin has no input')
     if not name:
@@ -263,9 +745,62 @@ def main(v1_token, v1_url, content_type, infile, name, report_name):
             raise ValueError(f'file_name must be specified for {infile.name}')
         name = os.path.basename(infile.name)
 
+    # Validate and de-duplicate indicators before uploading
+    spool = tempfile.TemporaryFile()
+    shutil.copyfileobj(infile, spool)
+    (fingerprints, errors, duplicate_count,
+     unsupported_count) = validate_intelligence_file(content_type, spool)
+    for line, message in errors:
+        print(message if line is None else f'Line {line}: {message}')
+    # a file that cannot be parsed is never uploaded, even with skip_invalid
+    if any(line is None for line, _ in errors):
+        raise ValueError(f'Unable to parse {name}')
+    if errors and not skip_invalid:
+        raise ValueError(f'{len(errors)} invalid indicators in {name}')
+    print(f'Indicators accepted: {len(fingerprints)}; Not validated: '
+          f'{unsupported_count}; Duplicated: {duplicate_count}; Invalid: '
+          f'{len(errors)}.')
+    if not fingerprints:
+        return
+    total_count = len(fingerprints)
+
+    indicator_index = None
+    if index:
+        indicator_index = IndicatorIndex(index)
+        fingerprints = select_due_indicators(indicator_index, fingerprints,
+                                             ttl)
+        print(f'Indicators new or due for sweeping: {len(fingerprints)} of'
+              f' {total_count}')
+        if not fingerprints:
+            indicator_index.close()
+            return
+    # the file is uploaded as it is unless indicators are removed
+    if errors or duplicate_count or (len(fingerprints) < total_count):
+        infile = write_intelligence_file(content_type, spool, fingerprints)
+        spool.close()
+    else:
+        infile = spool
+        infile.seek(0)
+
     v1 = TmV1Client(v1_token, v1_url)
     results = import_and_sweep(v1, infile, name, content_type, report_name)
 
+    if indicator_index is not None:
+        if all((task is not None) and ('succeeded' == task['status'])
+               for (_, _, _, task, _) in results):
+            indicator_index.mark_swept(fingerprints.values())
+        indicator_index.close()
+
+    if store:
+        hit_store = HitStore(store)
+        for (_, _, _, task, file_name) in results:
+            if file_name:
+                with open(file_name, 'rb') as f:
+                    count = hit_store.ingest(task, json.load(f), file_name)
+                print(f'Matched indicators stored: {count}'
+                      f' ({task["reportId"]})')
+        hit_store.close()
+
     print('')
     for (import_res, report, sweep_res, task, file_name) in results:
         if report is None:
@@ -317,9 +852,10 @@ if __name__ == '__main__':
               f' The default value is "{TmV1Client.base_url_default}"'))
     parser.add_argument(
         'content_type',
-        choices=TmV1Client.intelligence_report_content_types,
+        choices=[*TmV1Client.intelligence_report_content_types, 'query'],
         help=('File type of the file to be imported into a custom'
-              ' intelligence report.'))
+              " intelligence report, or 'query' to search the matched"
+              ' indicators stored with --store.'))
     parser.add_argument(
         'infile', nargs='?',
         type=argparse.FileType('rb'), default=sys.stdin.buffer,
@@ -334,4 +870,41 @@ if __name__ == '__main__':
     parser.add_argument(
         '-r', '--report-name',
         help='Name of the imported intelligence report.')
+    parser.add_argument(
+        '-i', '--index', default=V1_INDICATOR_INDEX,
+        help=('SQLite file of swept indicator fingerprints. When specified,'
+              ' only indicators that are new or were last swept more than'
+              " 'ttl' seconds ago are imported and swept."))
+    parser.add_argument(
+        '--ttl', type=int, default=V1_SWEEP_TTL,
+        help=('Seconds after which a swept indicator is due for sweeping'
+              f' again. The default value is {V1_SWEEP_TTL}'))
+    parser.add_argument(
+        '-s', '--skip-invalid', action='store_true',
+        help=('Import the valid indicators even if the file contains'
+              ' unsupported or malformed indicators. By default, nothing is'
+              ' imported when the local validation fails.'))
+    parser.add_argument(
+        '-d', '--store', default=V1_HIT_STORE,
+        help=('SQLite file that accumulates the matched indicators of every'
+              ' sweep run for the query operation.'))
+    query_group = parser.add_argument_group(
+        'query options',
+        (f'Example: python {os.path.basename(__file__)} -d hits.db query'
+         ' --since 2024-05-01 --group-by endpoint'))
+    query_group.add_argument(
+        '--since',
+        help='Earliest sweep time (ISO 8601) of the matched indicators.')
+    query_group.add_argument(
+        '--until',
+        help='Sweep time (ISO 8601) before which indicators were matched.')
+    query_group.add_argument(
+        '--indicator', help='Matched indicator pattern.')
+    query_group.add_argument(
+        '--endpoint', help='Endpoint that matched an indicator.')
+    query_group.add_argument(
+        '--report-id', help='ID of the custom intelligence report.')
+    query_group.add_argument(
+        '-g', '--group-by', choices=HIT_GROUP_COLUMNS,
+        help='Count the matched indicators per indicator, endpoint or report.')
     main(**vars(parser.parse_args()))
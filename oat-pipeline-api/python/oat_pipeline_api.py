@@ -1,11 +1,29 @@
 import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import glob
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import mmap
+import multiprocessing
 import os
 import pathlib
+import queue
+import re
+import shutil
 import signal
+import sys
+import tempfile
+import threading
 import time
 import uuid
+import zlib
 from pathlib import Path
 from requests import Session
 from requests.adapters import HTTPAdapter
@@ -21,12 +39,66 @@ V1_URL = os.environ.get("TMV1_URL", "https://api.xdr.trendmicro.com")
 V1_UA = os.environ.get(
     "TMV1_UA", f"Trend Vision One API Cookbook ({os.path.basename(__file__)})"
 )
+# Number of packages downloaded at the same time in continuous-get-packages
+V1_DOWNLOAD_WORKERS = int(os.environ.get("TMV1_DOWNLOAD_WORKERS", 4))
+# Maximum number of API requests per second sent by continuous-get-packages,
+# shared by all the captured pipelines
+#   default: 0 (no limit)
+V1_REQUESTS_PER_SECOND = float(os.environ.get("TMV1_REQUESTS_PER_SECOND", 0))
+# Size of the chunks in which packages are copied to disk
+V1_DOWNLOAD_CHUNK_SIZE = int(
+    os.environ.get("TMV1_DOWNLOAD_CHUNK_SIZE", 1024 * 1024)
+)
+
+
+class RateLimiter:
+    """
+    Spaces requests evenly so that no more than rate requests are sent per
+    second by all threads together.
+    """
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float): Maximum number of requests per second, 0 for no
+                          limit
+        """
+        self.period = 1 / rate if rate > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.period:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.period
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    HTTP adapter that waits for the rate limiter before each request,
+    including retried requests.
+    """
+
+    def __init__(self, rate_limiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.acquire()
+        return super().send(request, **kwargs)
 
 
 class TmV1Client:
     base_url_default = V1_URL
 
-    def __init__(self, token, base_url=None):
+    def __init__(self, token, base_url=None,
+                 pool_maxsize=V1_DOWNLOAD_WORKERS,
+                 requests_per_second=V1_REQUESTS_PER_SECOND):
         if not token:
             raise ValueError("Authentication token missing")
         self.endpoint_url = base_url + "{api}"
@@ -39,7 +111,11 @@ class TmV1Client:
             allowed_methods=["GET"],
             backoff_factor=1,
         )
-        http_adapter = HTTPAdapter(max_retries=retry)
+        # keep one connection per download worker
+        http_adapter = RateLimitedAdapter(
+            RateLimiter(requests_per_second),
+            max_retries=retry, pool_maxsize=max(10, pool_maxsize)
+        )
         self.session.mount("https://", http_adapter)
 
     def get_headers(self):
@@ -55,20 +131,20 @@ class TmV1Client:
             "User-Agent": self.user_agent,
         }
 
-    def get_items(self, api_path, **kwargs):
+    def iter_pages(self, api_path, next_link=None, **kwargs):
         """
-        Generic method to get all items from a paginated API endpoint.
+        Generic method to get the pages of a paginated API endpoint one
+        at a time, each as soon as it is received.
 
         Args:
             api_path (str): The API path to request
+            next_link (str, optional): nextLink of a previous response to
+                                       start from
             **kwargs: Additional parameters to pass to the request
 
         Returns:
-            dict: Response with all items combined from all pages
+            generator: Response of each page
         """
-        items = []
-        next_link = None
-        last_response = None
         while True:
             if next_link is None:
                 resp = self.session.get(
@@ -85,14 +161,49 @@ class TmV1Client:
                     f'{resp.status_code} {resp.text}'
                 )
             result = resp.json()
-            last_response = result
-            # Add items from this page
-            if "items" in result:
-                items.extend(result["items"])
+            yield result
             # Check for next page
             next_link = result.get("nextLink")
             if not next_link:
                 break
+
+    def iter_items(self, api_path, next_link=None, **kwargs):
+        """
+        Generic method to get the items of a paginated API endpoint one
+        at a time, without waiting for the following pages.
+
+        Args:
+            api_path (str): The API path to request
+            next_link (str, optional): nextLink of a previous response to
+                                       start from
+            **kwargs: Additional parameters to pass to the request
+
+        Returns:
+            generator: Items of all pages
+        """
+        for result in self.iter_pages(api_path, next_link, **kwargs):
+            yield from result.get("items", [])
+
+    def get_items(self, api_path, next_link=None, **kwargs):
+        """
+        Generic method to get all items from a paginated API endpoint.
+
+        Args:
+            api_path (str): The API path to request
+            next_link (str, optional): nextLink of a previous response to
+                                       start from
+            **kwargs: Additional parameters to pass to the request
+
+        Returns:
+            dict: Response with all items combined from all pages
+        """
+        items = []
+        last_response = None
+        for result in self.iter_pages(api_path, next_link, **kwargs):
+            last_response = result
+            # Add items from this page
+            if "items" in result:
+                items.extend(result["items"])
         # Create a response that mimics the API structure but with all items
         return {
             "items": items,
@@ -231,6 +342,7 @@ class TmV1Client:
             start_datetime (str, optional): Start time for filtering events
             end_datetime (str, optional): End time for filtering events
             top (int, optional): Maximum number of records to return
+            next_link (str, optional): nextLink of a previous response
         Returns:
             dict: JSON response from the API containing the event packages
         """
@@ -240,7 +352,32 @@ class TmV1Client:
             "endDateTime": end_datetime,
             "top": top,
         }
-        return self.get_items(api, params=params)
+        return self.get_items(api, next_link, params=params)
+
+    def iter_datapipeline_packages(
+        self, pipeline_id, start_datetime, end_datetime,
+        top=500, next_link=None
+    ):
+        """
+        Iterates over the available packages from a data pipeline, page
+        after page, so that the packages of the first page can be used
+        while the following pages are requested
+        Args:
+            pipeline_id (str): The ID of the data pipeline
+            start_datetime (str, optional): Start time for filtering events
+            end_datetime (str, optional): End time for filtering events
+            top (int, optional): Maximum number of records per page
+            next_link (str, optional): nextLink of a previous response
+        Returns:
+            generator: Package descriptors
+        """
+        api = f"/v3.0/oat/dataPipelines/{pipeline_id}/packages"
+        params = {
+            "startDateTime": start_datetime,
+            "endDateTime": end_datetime,
+            "top": top,
+        }
+        return self.iter_items(api, next_link, params=params)
 
     def get_datapipeline_package(self, pipeline_id, package_id):
         """
@@ -249,21 +386,48 @@ class TmV1Client:
             pipeline_id (str): The ID of the data pipeline
             package_id (str): The ID of the package to retrieve
         Returns:
-            dict: JSON response from the API containing the package details
+            bytes: Content of the gzip package
+        """
+        fd = io.BytesIO()
+        self.download_datapipeline_package(pipeline_id, package_id, fd)
+        return fd.getvalue()
+
+    def download_datapipeline_package(
+        self, pipeline_id, package_id, fd, chunk_size=V1_DOWNLOAD_CHUNK_SIZE
+    ):
+        """
+        Writes the specified Observed Attack Techniques package to a file
+        in fixed-size chunks, so that memory use does not depend on the
+        package size
+        Args:
+            pipeline_id (str): The ID of the data pipeline
+            package_id (str): The ID of the package to retrieve
+            fd (file): Binary file object the package is written to
+            chunk_size (int, optional): Size of the chunks read
+        Returns:
+            tuple: Size in bytes and SHA-256 checksum of the package
         """
         api = f"/v3.0/oat/dataPipelines/{pipeline_id}/packages/{package_id}"
-        resp = self.session.get(
+        with self.session.get(
             self.endpoint_url.format(api=api),
             headers=self.get_headers(), stream=True
-        )
-        print(f'resp={resp}, trace-id={resp.headers.get("x-trace-id")}')
-        if resp.status_code != 200:
-            raise RuntimeError(
-                f"Request unsuccessful "
-                f"({resp.request.method} {resp.url}): "
-                f"{resp.status_code} {resp.text}"
+        ) as resp:
+            print(
+                f'resp={resp}, trace-id={resp.headers.get("x-trace-id")}'
             )
-        return resp.raw.read()
+            if resp.status_code != 200:
+                raise RuntimeError(
+                    f"Request unsuccessful "
+                    f"({resp.request.method} {resp.url}): "
+                    f"{resp.status_code} {resp.text}"
+                )
+            size = 0
+            checksum = hashlib.sha256()
+            for chunk in resp.raw.stream(chunk_size, decode_content=False):
+                fd.write(chunk)
+                size += len(chunk)
+                checksum.update(chunk)
+        return size, checksum.hexdigest()
 
     def delete_datapipeline(self, pipeline_id_list):
         """
@@ -297,15 +461,1333 @@ def signal_int_handler(sig, frame):
         frame: Current stack frame
     """
     print("stop capturing")
-    global CAPTURING
-    CAPTURING = False
+    STOP_CAPTURING.set()
+
+
+# event set to stop continuous-get-packages mode
+STOP_CAPTURING = threading.Event()
+
+
+class WindowScheduler:
+    """
+    Lists the packages of consecutive time windows of interval seconds,
+    each as soon as its window ends. The window ends are converted to
+    deadlines on the monotonic clock, so that they do not drift with the
+    processing time or with changes of the system clock. Packages are
+    listed in a background thread and handed over page by page, so that
+    downloads start with the first page and the next window is listed
+    while the packages of the current window are downloaded. Waits end as
+    soon as STOP_CAPTURING is set.
+    """
+
+    def __init__(self, list_packages, start_datetime, interval):
+        """
+        Args:
+            list_packages (callable): Called with the start and end
+                                      datetime of a window, returns an
+                                      iterable of the packages of the
+                                      window
+            start_datetime (datetime): Start of the first window
+            interval (int): Length of the windows in seconds
+        """
+        self.list_packages = list_packages
+        self.interval = datetime.timedelta(seconds=interval)
+        self.windows = queue.Queue()
+        self.lister = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.lister.submit(self.fetch, start_datetime)
+
+    def fetch(self, start_datetime):
+        end_datetime = start_datetime + self.interval
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        deadline = time.monotonic() + (end_datetime - now).total_seconds()
+        if STOP_CAPTURING.wait(max(0, deadline - time.monotonic())):
+            self.windows.put(None)
+            return
+        items = queue.Queue()
+        self.windows.put(
+            (start_datetime, end_datetime, self.iter_queue(items))
+        )
+        try:
+            # the listing ends between two pages once STOP_CAPTURING is set
+            for item in self.list_packages(start_datetime, end_datetime):
+                if STOP_CAPTURING.is_set():
+                    break
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        else:
+            items.put((None, None))
+
+    @staticmethod
+    def iter_queue(items):
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is None:
+                return
+            yield item
+
+    def __iter__(self):
+        while True:
+            window = self.windows.get()
+            if window is None:
+                return
+            # runs once the listing of this window is complete
+            self.lister.submit(self.fetch, window[1])
+            yield window
+
+    def close(self):
+        STOP_CAPTURING.set()
+        self.lister.shutdown(wait=True)
+
+
+def iter_packages(
+    client, pipeline_id, package_ids, pool, workers, on_package=None
+):
+    """
+    Download packages concurrently and yield them in the given order.
+    Each package is streamed to a temporary file, and at most twice as
+    many packages as workers are downloaded ahead of the package being
+    yielded.
+    Args:
+        client (TmV1Client): API client
+        pipeline_id (str): The ID of the data pipeline
+        package_ids (list): IDs of the packages to download
+        pool (ThreadPoolExecutor): Download workers, which can be shared
+                                   by several pipelines
+        workers (int): Number of workers of the pool
+        on_package (callable, optional): Called by the download workers
+                                         with the package ID and the
+                                         file of each package
+    Returns:
+        generator: (package_id, fd, size, checksum) tuples in package_ids
+                   order, where fd is the temporary file of the package,
+                   closed when the next package is yielded
+    """
+    def download(package_id):
+        fd = tempfile.TemporaryFile()
+        try:
+            size, checksum = client.download_datapipeline_package(
+                pipeline_id=pipeline_id, package_id=package_id, fd=fd
+            )
+            fd.seek(0)
+            if on_package is not None:
+                on_package(package_id, fd)
+                fd.seek(0)
+        except BaseException:
+            fd.close()
+            raise
+        return fd, size, checksum
+
+    package_ids = iter(package_ids)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                package_id = next(package_ids, None)
+                if package_id is None:
+                    break
+                pending.append(
+                    (package_id, pool.submit(download, package_id))
+                )
+            if not pending:
+                break
+            package_id, future = pending.popleft()
+            fd, size, checksum = future.result()
+            with fd:
+                yield package_id, fd, size, checksum
+    finally:
+        for _, future in pending:
+            if not future.cancel() and not future.exception():
+                future.result()[0].close()
+
+
+class CaptureCheckpoint:
+    """
+    Progress of continuous-get-packages, saved atomically to a JSON file
+    after each bundle so that a restarted capture resumes where it stopped.
+    The file keeps the start of the window being captured, which is the
+    end of the last completed window, and the IDs of the packages already
+    saved for this window and for the previous one.
+    """
+
+    def __init__(self, path, pipeline_id):
+        self.path = pathlib.Path(path)
+        self.pipeline_id = pipeline_id
+        self.window_start = None
+        self.package_ids = []
+        self.previous_package_ids = []
+        if self.path.exists():
+            with open(self.path) as fd:
+                data = json.load(fd)
+            if data["pipelineId"] != pipeline_id:
+                raise ValueError(
+                    f"Checkpoint {self.path} belongs to pipeline "
+                    f"{data['pipelineId']}"
+                )
+            self.window_start = datetime.datetime.strptime(
+                data["windowStartDateTime"], "%Y-%m-%dT%H:%M:%SZ"
+            ).replace(tzinfo=datetime.timezone.utc)
+            self.package_ids = data["packageIds"]
+            self.previous_package_ids = data["previousPackageIds"]
+        self.saved = set(self.package_ids) | set(self.previous_package_ids)
+
+    def save(self):
+        """
+        Write the checkpoint to a temporary file and replace the previous
+        checkpoint with it.
+        """
+        data = {
+            "pipelineId": self.pipeline_id,
+            "windowStartDateTime": (
+                self.window_start.strftime("%Y-%m-%dT%H:%M:%SZ")
+            ),
+            "packageIds": self.package_ids,
+            "previousPackageIds": self.previous_package_ids,
+        }
+        part_path = self.path.with_name(self.path.name + ".part")
+        with open(part_path, "w") as fd:
+            json.dump(data, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(part_path, self.path)
+
+    def add_packages(self, package_ids):
+        """
+        Record packages saved in a bundle of the current window.
+        Args:
+            package_ids (list): IDs of the packages
+        """
+        self.package_ids.extend(package_ids)
+        self.saved.update(package_ids)
+        self.save()
+
+    def complete_window(self, window_end):
+        """
+        Record that all packages of the current window are saved.
+        Args:
+            window_end (datetime): End of the current window
+        """
+        self.window_start = window_end
+        self.previous_package_ids = self.package_ids
+        self.package_ids = []
+        self.saved = set(self.previous_package_ids)
+        self.save()
 
 
-# flag to indicate if continue in continuous-get-packages mode
-CAPTURING = True
+def get_bundle_index_path(bundle_path):
+    """
+    Get the path of the index file written next to a bundle.
+    Args:
+        bundle_path (str): Path of the bundle
+    Returns:
+        Path: Path of the index file
+    """
+    return pathlib.Path(f"{bundle_path}.index.json")
+
+
+def write_bundle_index(bundle_path, start_time_str, end_time_str, packages):
+    """
+    Write the index of a bundle to a temporary file renamed once complete.
+    Args:
+        bundle_path (str): Path of the bundle
+        start_time_str (str): Start of the time window of the bundle
+        end_time_str (str): End of the time window of the bundle
+        packages (list): Package entries with id, offset, length, sha256
+                         and createdDateTime
+    """
+    index_path = get_bundle_index_path(bundle_path)
+    part_path = index_path.with_name(index_path.name + ".part")
+    with open(part_path, "w") as fd:
+        json.dump({
+            "bundle": pathlib.Path(bundle_path).name,
+            "startDateTime": start_time_str,
+            "endDateTime": end_time_str,
+            "packages": packages,
+        }, fd, indent=2)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(part_path, index_path)
+
+
+class BundleReader:
+    """
+    Reads single packages from a bundle without scanning it. The bundle is
+    memory-mapped and the offset and length of each package are read from
+    the index file written next to it by continuous-get-packages.
+    """
+
+    def __init__(self, bundle_path):
+        """
+        Args:
+            bundle_path (str): Path of the bundle
+        """
+        with open(get_bundle_index_path(bundle_path)) as fd:
+            self.index = json.load(fd)
+        self.packages = {p["id"]: p for p in self.index["packages"]}
+        self.fd = open(bundle_path, "rb")
+        self.map = None
+        if os.fstat(self.fd.fileno()).st_size:
+            self.map = mmap.mmap(
+                self.fd.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fd.close()
+
+    def __iter__(self):
+        return iter(p["id"] for p in self.index["packages"])
+
+    def get_package(self, package_id, verify=True):
+        """
+        Get the content of a package.
+        Args:
+            package_id (str): The ID of the package
+            verify (bool, optional): Whether to check the SHA-256 checksum
+        Returns:
+            bytes: Content of the gzip package
+        """
+        package = self.packages.get(package_id)
+        if package is None:
+            raise KeyError(f"Package not found in bundle: {package_id}")
+        offset = package["offset"]
+        content = self.map[offset:offset + package["length"]]
+        if verify and hashlib.sha256(content).hexdigest() != package["sha256"]:
+            raise ValueError(f"Package checksum mismatch: {package_id}")
+        return content
+
+
+def capture_packages(
+    client, pipeline_id, items, output_path, start_time_str, end_time_str,
+    max_items_batch, pool, workers, checkpoint, on_package=None
+):
+    """
+    Save the packages of a time window to bundles of max_items_batch
+    packages. Packages are written to each bundle in the listed order.
+    Packages already saved according to the checkpoint are skipped, and
+    each bundle is written to a temporary file renamed once complete,
+    with an index file of the offset, length and checksum of its packages.
+    When STOP_CAPTURING is set, the capture stops after the current bundle.
+    Args:
+        client (TmV1Client): API client
+        pipeline_id (str): The ID of the data pipeline
+        items (iterable): Packages listed for the time window
+        output_path (Path): Directory of the bundles
+        start_time_str (str): Start of the time window
+        end_time_str (str): End of the time window
+        max_items_batch (int): Maximum number of packages in a bundle
+        pool (ThreadPoolExecutor): Download workers
+        workers (int): Number of workers of the pool
+        checkpoint (CaptureCheckpoint): Progress of the capture
+        on_package (callable, optional): Called with the ID and the file
+                                         of each downloaded package
+    Returns:
+        bool: True if all packages of the window are saved
+    """
+    created = {}
+    skipped_count = 0
+
+    def iter_new_package_ids():
+        nonlocal skipped_count
+        for item in items:
+            if item["id"] in checkpoint.saved or item["id"] in created:
+                skipped_count += 1
+                continue
+            created[item["id"]] = item.get("createdDateTime")
+            yield item["id"]
+
+    package_ids = iter_new_package_ids()
+    # bundles of a resumed window continue the numbering of the packages
+    # already saved for this window
+    batch_idx = len(checkpoint.package_ids)
+    while True:
+        if STOP_CAPTURING.is_set():
+            return False
+        # packages are downloaded as they are listed, so the bundle is
+        # named once the number of its packages is known
+        part_path = output_path.joinpath(
+            f"bundle-{start_time_str}-{end_time_str}-batch{batch_idx}.gz.part"
+        )
+        packages = []
+        with open(part_path, "wb") as fd:
+            for package_id, package_fd, size, checksum in iter_packages(
+                client, pipeline_id,
+                itertools.islice(package_ids, max_items_batch), pool, workers,
+                on_package
+            ):
+                packages.append({
+                    "id": package_id,
+                    "offset": fd.tell(),
+                    "length": size,
+                    "sha256": checksum,
+                    "createdDateTime": created[package_id],
+                })
+                shutil.copyfileobj(package_fd, fd, V1_DOWNLOAD_CHUNK_SIZE)
+                print(
+                    f"- saved package: {package_id}, size={size}, "
+                    f"sha256={checksum}"
+                )
+            fd.flush()
+            os.fsync(fd.fileno())
+        if not packages:
+            part_path.unlink()
+            break
+    # the listing of the window is cut short when STOP_CAPTURING is set
+    if STOP_CAPTURING.is_set():
+        return False
+        batch_end = batch_idx + len(packages)
+        bundle_path = output_path.joinpath(
+            f"bundle-{start_time_str}-{end_time_str}"
+            f"-batch{batch_idx}-{batch_end}.gz"
+        )
+        write_bundle_index(bundle_path, start_time_str, end_time_str, packages)
+        os.replace(part_path, bundle_path)
+        checkpoint.add_packages([p["id"] for p in packages])
+        print(f"Batch complete: {len(packages)} successful packages")
+        print(f"Saved to bundle: {bundle_path}")
+        batch_idx = batch_end
+    print(
+        f"Found {len(created) + skipped_count} packages, "
+        f"{skipped_count} already saved"
+    )
+    return True
+
+
+def capture_pipeline(
+    client, pipeline_id, output_path, checkpoint_path, interval, top,
+    max_items_batch, pool, workers, on_package=None
+):
+    """
+    Capture the packages of a pipeline window after window until
+    STOP_CAPTURING is set.
+    Args:
+        client (TmV1Client): API client
+        pipeline_id (str): The ID of the data pipeline
+        output_path (Path): Directory of the bundles
+        checkpoint_path (str): Checkpoint file, defaults to
+                               checkpoint.json in output_path
+        interval (int): Length of the time windows in seconds
+        top (int): Maximum number of packages per listing page
+        max_items_batch (int): Maximum number of packages in a bundle
+        pool (ThreadPoolExecutor): Download workers
+        workers (int): Number of workers of the pool
+        on_package (callable, optional): Called with the ID and the file
+                                         of each downloaded package
+    """
+    output_path.mkdir(parents=True, exist_ok=True)
+    checkpoint = CaptureCheckpoint(
+        checkpoint_path or output_path.joinpath("checkpoint.json"),
+        pipeline_id
+    )
+    if checkpoint.window_start is None:
+        checkpoint.window_start = (
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        checkpoint.save()
+    else:
+        print(
+            f"[{pipeline_id}] resume capturing from checkpoint: ",
+            checkpoint.window_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+    start_datetime = checkpoint.window_start
+    end_datetime = start_datetime + datetime.timedelta(seconds=interval)
+    print(
+        f"[{pipeline_id}] start capturing..., next request is around: ",
+        end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    )
+
+    def list_packages(start_datetime, end_datetime):
+        start_time_str = start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+        end_time_str = end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+        print(
+            f"[{pipeline_id}] Fetching packages for time window: "
+            f"{start_time_str} to {end_time_str}"
+        )
+        return client.iter_datapipeline_packages(
+            pipeline_id=pipeline_id,
+            start_datetime=start_time_str,
+            end_datetime=end_time_str,
+            top=top
+        )
+
+    # windows that ended while the capture was stopped are due
+    # immediately, so they are fetched one after the other
+    scheduler = WindowScheduler(list_packages, start_datetime, interval)
+    try:
+        for start_datetime, end_datetime, items in scheduler:
+            completed = capture_packages(
+                client, pipeline_id, items, output_path,
+                start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                max_items_batch, pool, workers, checkpoint, on_package
+            )
+            if not completed:
+                break
+            checkpoint.complete_window(end_datetime)
+            next_end_datetime = (
+                end_datetime + datetime.timedelta(seconds=interval)
+            )
+            print(
+                f"[{pipeline_id}] Next time window: "
+                f"{end_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')} "
+                f"to {next_end_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+            )
+            if next_end_datetime <= datetime.datetime.now(
+                tz=datetime.timezone.utc
+            ):
+                print(f"[{pipeline_id}] catching up...")
+    finally:
+        scheduler.close()
+
+
+# OAT risk levels from the lowest to the highest
+OAT_RISK_LEVELS = ["info", "low", "medium", "high", "critical"]
+
+
+def iter_oat_events(bundle_path):
+    """
+    Decompress a bundle or package and yield its OAT events one at a time.
+    The gzip members of the packages in a bundle are decompressed as one
+    stream, and each line holds one event or a list of events.
+    Args:
+        bundle_path (str): Path or binary file object of the bundle or
+                           package
+    Returns:
+        generator: OAT events as dict
+    """
+    with gzip.open(bundle_path, "rt", encoding="utf-8") as fd:
+        for line in fd:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if isinstance(event, list):
+                yield from event
+            else:
+                yield event
+
+
+def get_oat_risk_level(event):
+    """
+    Get the highest risk level of the filters matched by an OAT event.
+    Args:
+        event (dict): OAT event
+    Returns:
+        str: Risk level, "info" if the event has no filter
+    """
+    levels = [
+        OAT_RISK_LEVELS.index(f["riskLevel"])
+        for f in event.get("filters", [])
+        if f.get("riskLevel") in OAT_RISK_LEVELS
+    ]
+    return OAT_RISK_LEVELS[max(levels, default=0)]
+
+
+def match_oat_event(event, risk_levels=None, techniques=None, endpoints=None):
+    """
+    Check an OAT event against the decode filters. Each filter that is
+    specified must match.
+    Args:
+        event (dict): OAT event
+        risk_levels (list, optional): Risk levels of the matched filters
+        techniques (list, optional): MITRE technique IDs of the matched
+                                     filters. T1059 also matches T1059.001
+        endpoints (list, optional): Endpoint names, agent GUIDs or IPs
+    Returns:
+        bool: True if the event matches
+    """
+    filters = event.get("filters", [])
+    if risk_levels and not any(
+        f.get("riskLevel") in risk_levels for f in filters
+    ):
+        return False
+    if techniques and not any(
+        t == technique or t.startswith(technique + ".")
+        for f in filters
+        for t in f.get("mitreTechniqueIds", [])
+        for technique in techniques
+    ):
+        return False
+    if endpoints:
+        endpoint = event.get("endpoint") or {}
+        values = {endpoint.get("endpointName"), endpoint.get("agentGuid")}
+        values.update(endpoint.get("ips") or [])
+        if not values.intersection(endpoints):
+            return False
+    return True
+
+
+def decode_bundle(
+    bundle_path, output_dir, risk_levels=None, techniques=None,
+    endpoints=None
+):
+    """
+    Decode the OAT events of a bundle into NDJSON.gz files partitioned by
+    detection date and risk level:
+    <output_dir>/date=<YYYY-MM-DD>/risk=<level>/<bundle>-<dir>.ndjson.gz
+    where <dir> is a hash of the directory of the bundle, so that bundles
+    with the same name in different directories do not overwrite each
+    other. Files are written as .part files and renamed once the bundle is
+    decoded, so that several bundles can be decoded at the same time.
+    Args:
+        bundle_path (str): Path of the bundle
+        output_dir (str): Directory of the partitions
+        risk_levels (list, optional): Risk levels to keep
+        techniques (list, optional): MITRE technique IDs to keep
+        endpoints (list, optional): Endpoint names, agent GUIDs or IPs
+                                    to keep
+    Returns:
+        tuple: Number of events read and number of events written
+    """
+    output_dir = pathlib.Path(output_dir)
+    bundle_path = pathlib.Path(bundle_path)
+    file_name = bundle_path.name
+    if file_name.endswith(".gz"):
+        file_name = file_name[:-3]
+    dir_hash = hashlib.sha1(
+        str(bundle_path.resolve().parent).encode()
+    ).hexdigest()[:8]
+    file_name += f"-{dir_hash}.ndjson.gz"
+    writers = {}
+    read_count = 0
+    written_count = 0
+    try:
+        for event in iter_oat_events(bundle_path):
+            read_count += 1
+            if not isinstance(event, dict):
+                continue
+            if not match_oat_event(event, risk_levels, techniques, endpoints):
+                continue
+            detected = event.get("detectedDateTime")
+            if not isinstance(detected, str) or not detected:
+                detected = "unknown"
+            partition = (detected[:10], get_oat_risk_level(event))
+            if partition not in writers:
+                path = output_dir.joinpath(
+                    f"date={partition[0]}", f"risk={partition[1]}", file_name
+                )
+                path.parent.mkdir(parents=True, exist_ok=True)
+                part_path = path.with_name(path.name + ".part")
+                writers[partition] = (
+                    path, part_path,
+                    gzip.open(part_path, "wt", encoding="utf-8")
+                )
+            writers[partition][2].write(json.dumps(event) + "\n")
+            written_count += 1
+    except BaseException:
+        for path, part_path, fd in writers.values():
+            fd.close()
+            part_path.unlink()
+        raise
+    for path, part_path, fd in writers.values():
+        fd.close()
+        os.replace(part_path, path)
+    return read_count, written_count
+
+
+def decode_bundles(
+    bundle_paths, output_dir, risk_levels=None, techniques=None,
+    endpoints=None, jobs=None
+):
+    """
+    Decode bundles on several processes.
+    Args:
+        bundle_paths (list): Paths of the bundles
+        output_dir (str): Directory of the partitions
+        risk_levels (list, optional): Risk levels to keep
+        techniques (list, optional): MITRE technique IDs to keep
+        endpoints (list, optional): Endpoint names, agent GUIDs or IPs
+                                    to keep
+        jobs (int, optional): Number of processes. Defaults to the number
+                              of CPUs
+    Returns:
+        tuple: Number of events read, number of events written and number
+               of bundles that could not be read
+    """
+    total_read = 0
+    total_written = 0
+    error_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                decode_bundle, bundle_path, output_dir, risk_levels,
+                techniques, endpoints
+            ): bundle_path
+            for bundle_path in bundle_paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                read_count, written_count = future.result()
+            except (OSError, EOFError, ValueError, zlib.error) as e:
+                print(f"Unable to decode bundle {futures[future]}: {e}")
+                error_count += 1
+                continue
+            print(
+                f"- decoded bundle: {futures[future]}, "
+                f"events={read_count}, written={written_count}"
+            )
+            total_read += read_count
+            total_written += written_count
+    return total_read, total_written, error_count
+
+
+class CountMinSketch:
+    """
+    Approximate counts of any number of keys in fixed memory. A count is
+    never underestimated, and is overestimated by at most 2 / width of the
+    total count with probability 1 - 1 / 2 ** depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        """
+        Args:
+            width (int, optional): Number of counters per row
+            depth (int, optional): Number of rows
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array("Q", bytes(8 * width)) for _ in range(depth)]
+
+    def get_columns(self, key):
+        digest = hashlib.blake2b(
+            key.encode("utf-8"), digest_size=8 * self.depth
+        ).digest()
+        return [
+            int.from_bytes(digest[i * 8:i * 8 + 8], "little") % self.width
+            for i in range(self.depth)
+        ]
+
+    def add(self, key, count=1):
+        """
+        Add to the count of a key.
+        Args:
+            key (str): Key to count
+            count (int, optional): Value added to the count
+        Returns:
+            int: Estimated count of the key
+        """
+        estimate = None
+        for row, column in zip(self.rows, self.get_columns(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def get(self, key):
+        return min(
+            row[column]
+            for row, column in zip(self.rows, self.get_columns(key))
+        )
+
+
+class TopK:
+    """
+    The k keys with the highest counts, estimated with a count-min sketch
+    so that memory does not grow with the number of distinct keys.
+    """
+
+    def __init__(self, k=20, width=2048, depth=4):
+        """
+        Args:
+            k (int, optional): Number of keys kept
+            width (int, optional): Number of counters per sketch row
+            depth (int, optional): Number of sketch rows
+        """
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+
+    def add(self, key, count=1):
+        estimate = self.sketch.add(key, count)
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+            return
+        smallest = min(self.top, key=self.top.get)
+        if estimate > self.top[smallest]:
+            del self.top[smallest]
+            self.top[key] = estimate
+
+    def get_items(self):
+        """
+        Returns:
+            list: (key, estimated count) tuples, highest count first
+        """
+        return sorted(self.top.items(), key=lambda x: (-x[1], x[0]))
+
+
+class OatAggregator:
+    """
+    Running counts of the OAT events of the captured packages by risk
+    level, MITRE technique and endpoint. Risk levels are counted exactly,
+    and techniques and endpoints with TopK sketches, so that memory stays
+    fixed. Packages can be added from several threads, and the counts are
+    written to a JSON summary every interval seconds and when closed.
+    """
+
+    def __init__(self, path, interval=60, k=20):
+        """
+        Args:
+            path (str): Path of the JSON summary
+            interval (int, optional): Seconds between summary updates
+            k (int, optional): Number of techniques and endpoints kept
+        """
+        self.path = pathlib.Path(path)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.package_count = 0
+        self.event_count = 0
+        self.risk_levels = collections.Counter()
+        self.techniques = TopK(k)
+        self.endpoints = TopK(k)
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def add_package(self, package_id, fd):
+        """
+        Decode a package and count its events.
+        Args:
+            package_id (str): The ID of the package
+            fd (file): Binary file object of the gzip package
+        """
+        # a package that cannot be decoded is still captured
+        try:
+            for event in iter_oat_events(fd):
+                if not isinstance(event, dict):
+                    continue
+                with self.lock:
+                    self.add_event(event)
+        except (OSError, EOFError, ValueError, zlib.error) as e:
+            print(f"Unable to aggregate package {package_id}: {e}")
+        with self.lock:
+            self.package_count += 1
+
+    def add_event(self, event):
+        self.event_count += 1
+        self.risk_levels[get_oat_risk_level(event)] += 1
+        techniques = {
+            t
+            for f in event.get("filters", [])
+            for t in f.get("mitreTechniqueIds", [])
+        }
+        for technique in techniques:
+            self.techniques.add(technique)
+        endpoint = event.get("endpoint") or {}
+        name = endpoint.get("endpointName") or endpoint.get("agentGuid")
+        if name:
+            self.endpoints.add(name)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the counts to a temporary file and replace the previous
+        summary with it.
+        """
+        with self.lock:
+            summary = {
+                "startDateTime": self.started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "updatedDateTime": datetime.datetime.now(
+                    tz=datetime.timezone.utc
+                ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "packageCount": self.package_count,
+                "eventCount": self.event_count,
+                "riskLevels": {
+                    r: self.risk_levels[r] for r in OAT_RISK_LEVELS
+                },
+                "topTechniques": [
+                    {"id": k, "count": v}
+                    for k, v in self.techniques.get_items()
+                ],
+                "topEndpoints": [
+                    {"name": k, "count": v}
+                    for k, v in self.endpoints.get_items()
+                ],
+            }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = self.path.with_name(self.path.name + ".part")
+        with open(part_path, "w") as fd:
+            json.dump(summary, fd, indent=2)
+        os.replace(part_path, self.path)
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+
+
+class AhoCorasick:
+    """
+    Finds all the patterns of a list contained in a string in one pass,
+    whatever the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        """
+        Args:
+            patterns (list): (pattern, value) tuples, where value is
+                             returned when pattern is found
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for pattern, value in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(value)
+        # failure links are set breadth first, so that the link of a state
+        # points to a state already linked
+        states = collections.deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, next_state in self.goto[state].items():
+                states.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """
+        Args:
+            text (str): String to search
+        Returns:
+            set: Values of the patterns found in text
+        """
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+def get_oat_event_values(event, field):
+    """
+    Get the values of a field of an OAT event. Lists are searched at every
+    level of the field path, so "filters.riskLevel" returns the risk level
+    of each filter.
+    Args:
+        event (dict): OAT event
+        field (str): Dot-separated field path. Ex: detail.processCmd
+    Returns:
+        list: Values of the field as strings
+    """
+    values = [event]
+    for key in field.split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                next_values.extend(
+                    v[key] for v in value
+                    if isinstance(v, dict) and v.get(key) is not None
+                )
+            elif isinstance(value, dict) and value.get(key) is not None:
+                next_values.append(value[key])
+        values = next_values
+    strings = []
+    for value in values:
+        for v in value if isinstance(value, list) else [value]:
+            if isinstance(v, str):
+                strings.append(v)
+            elif not isinstance(v, dict):
+                strings.append(json.dumps(v))
+    return strings
+
+
+def load_oat_rules(rules_path):
+    """
+    Load and check the detection rules of a rules file.
+    Args:
+        rules_path (str): Path of the JSON rules file
+    Returns:
+        list: Rules as dict
+    """
+    with open(rules_path) as fd:
+        rules = json.load(fd)
+    if isinstance(rules, dict):
+        rules = rules.get("rules")
+    if not isinstance(rules, list) or not rules:
+        raise ValueError(f"No rule found in rules file: {rules_path}")
+    # compiling the rules reports invalid rules before capturing
+    OatRuleMatcher(rules)
+    return rules
+
+
+class OatRuleMatcher:
+    """
+    Detection rules compiled once and matched against OAT events. A rule
+    matches an event when all its conditions match. A condition matches
+    when any value of its field equals one of the "equals" values,
+    contains one of the "contains" strings, or matches the "regex". The
+    "contains" strings of all the rules are searched with one Aho-Corasick
+    automaton per field, so that matching does not slow down with the
+    number of strings.
+    """
+
+    OPERATORS = ["equals", "contains", "regex"]
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules (list): Rules as dict with name, optional severity and
+                          conditions
+        """
+        self.rules = []
+        patterns = collections.defaultdict(list)
+        condition_ids = itertools.count()
+        for rule in rules:
+            name = rule.get("name")
+            conditions = rule.get("conditions")
+            if not name or not conditions:
+                raise ValueError(f"Rule without name or conditions: {rule}")
+            checks = []
+            for condition in conditions:
+                field = condition.get("field")
+                operators = [o for o in self.OPERATORS if o in condition]
+                if not field or len(operators) != 1:
+                    raise ValueError(
+                        f"Condition of rule {name} must have a field and "
+                        f"one of {self.OPERATORS}: {condition}"
+                    )
+                operator = operators[0]
+                value = condition[operator]
+                ignore_case = bool(condition.get("ignoreCase"))
+                if operator == "regex":
+                    try:
+                        value = re.compile(
+                            value, re.IGNORECASE if ignore_case else 0
+                        )
+                    except (re.error, TypeError) as e:
+                        raise ValueError(
+                            f"Invalid regex in rule {name}: {e}"
+                        ) from e
+                    checks.append((operator, field, ignore_case, value))
+                    continue
+                values = value if isinstance(value, list) else [value]
+                values = [
+                    v if isinstance(v, str) else json.dumps(v)
+                    for v in values
+                ]
+                if ignore_case:
+                    values = [v.lower() for v in values]
+                if operator == "equals":
+                    checks.append(
+                        (operator, field, ignore_case, frozenset(values))
+                    )
+                    continue
+                if not all(values):
+                    raise ValueError(f"Empty string in rule {name}")
+                # strings are found by the automaton of the field, which
+                # returns the IDs of the conditions they belong to
+                condition_id = next(condition_ids)
+                patterns[(field, ignore_case)].extend(
+                    (v, condition_id) for v in values
+                )
+                checks.append((operator, field, ignore_case, condition_id))
+            self.rules.append((rule, checks))
+        self.automata = {
+            key: AhoCorasick(p) for key, p in patterns.items()
+        }
+
+    def match(self, event):
+        """
+        Args:
+            event (dict): OAT event
+        Returns:
+            list: Rules matched by the event
+        """
+        cache = {}
+
+        def get_values(field, ignore_case):
+            if (field, ignore_case) not in cache:
+                values = get_oat_event_values(event, field)
+                if ignore_case:
+                    values = [v.lower() for v in values]
+                cache[(field, ignore_case)] = values
+            return cache[(field, ignore_case)]
+
+        found = set()
+        for (field, ignore_case), automaton in self.automata.items():
+            for value in get_values(field, ignore_case):
+                found |= automaton.search(value)
+        matched = []
+        for rule, checks in self.rules:
+            for operator, field, ignore_case, value in checks:
+                if operator == "contains":
+                    if value not in found:
+                        break
+                elif operator == "equals":
+                    if value.isdisjoint(get_values(field, ignore_case)):
+                        break
+                elif not any(
+                    value.search(v) for v in get_values(field, False)
+                ):
+                    break
+            else:
+                matched.append(rule)
+        return matched
+
+
+# Rule matcher of a matching process, compiled once when the process starts
+_oat_rule_matcher = None
+
+
+def init_oat_rule_matcher(rules):
+    global _oat_rule_matcher
+    # Ctrl+C is handled by the main process, which stops the matching
+    # processes once the packages being matched are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _oat_rule_matcher = OatRuleMatcher(rules)
+
+
+def match_oat_events(source, path):
+    """
+    Match the OAT events of a package or bundle against the rules of the
+    process. Runs on the matching processes.
+    Args:
+        source (str): Package ID or bundle path written in the alerts
+        path (str): Path of the gzip package or bundle
+    Returns:
+        tuple: Number of events read and list of alerts
+    """
+    event_count = 0
+    alerts = []
+    for event in iter_oat_events(path):
+        event_count += 1
+        for rule in _oat_rule_matcher.match(event):
+            alerts.append({
+                "ruleName": rule["name"],
+                "severity": rule.get("severity"),
+                "source": source,
+                "matchedDateTime": datetime.datetime.now(
+                    tz=datetime.timezone.utc
+                ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "event": event,
+            })
+    return event_count, alerts
+
+
+def write_oat_alerts(fd, alerts):
+    for alert in alerts:
+        fd.write(json.dumps(alert) + "\n")
+    fd.flush()
+
+
+def match_bundles(rules, bundle_paths, alerts_path, jobs=None):
+    """
+    Match the OAT events of bundles against detection rules on several
+    processes, and append the alerts of each bundle to an NDJSON file as
+    soon as the bundle is matched.
+    Args:
+        rules (list): Rules as dict
+        bundle_paths (list): Paths of the bundles
+        alerts_path (str): Path of the NDJSON alerts file
+        jobs (int, optional): Number of processes. Defaults to the number
+                              of CPUs
+    Returns:
+        tuple: Number of events read, number of alerts written and number
+               of bundles that could not be read
+    """
+    total_read = 0
+    total_alerts = 0
+    error_count = 0
+    alerts_path = pathlib.Path(alerts_path)
+    alerts_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(alerts_path, "a", encoding="utf-8") as fd, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_oat_rule_matcher,
+                initargs=(rules,)
+            ) as pool:
+        futures = {
+            pool.submit(match_oat_events, bundle_path, bundle_path):
+                bundle_path
+            for bundle_path in bundle_paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            # a bundle that cannot be read does not stop the others
+            try:
+                read_count, alerts = future.result()
+            except (OSError, EOFError, ValueError, zlib.error) as e:
+                print(f"Unable to match bundle {futures[future]}: {e}")
+                error_count += 1
+                continue
+            write_oat_alerts(fd, alerts)
+            print(
+                f"- matched bundle: {futures[future]}, "
+                f"events={read_count}, alerts={len(alerts)}"
+            )
+            total_read += read_count
+            total_alerts += len(alerts)
+    return total_read, total_alerts, error_count
+
+
+class OatAlertStage:
+    """
+    Matches the OAT events of the captured packages against detection rules
+    on worker processes, and appends the alerts of each package to an
+    NDJSON file as soon as the package is matched, without waiting for its
+    bundle. When matching falls behind, the download workers wait until
+    fewer than twice as many packages as processes are being matched.
+    """
+
+    def __init__(self, rules, path, jobs=None):
+        """
+        Args:
+            rules (list): Rules as dict
+            path (str): Path of the NDJSON alerts file
+            jobs (int, optional): Number of processes. Defaults to the
+                                  number of CPUs
+        """
+        jobs = jobs or os.cpu_count() or 1
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = open(self.path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.pending = threading.Semaphore(jobs * 2)
+        # the capture threads are running, so the processes are spawned
+        # instead of forked
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_oat_rule_matcher, initargs=(rules,)
+        )
+
+    def add_package(self, package_id, fd):
+        """
+        Send a package to the matching processes. The package is copied to
+        a spool file read by the process and deleted once matched, since
+        the file of the download is closed with the next package.
+        Args:
+            package_id (str): The ID of the package
+            fd (file): Binary file object of the gzip package
+        """
+        self.pending.acquire()
+        spool = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                suffix=".gz", delete=False
+            ) as spool:
+                shutil.copyfileobj(fd, spool, V1_DOWNLOAD_CHUNK_SIZE)
+            future = self.pool.submit(match_oat_events, package_id,
+                                      spool.name)
+        except BaseException:
+            if spool is not None:
+                os.unlink(spool.name)
+            self.pending.release()
+            raise
+        future.add_done_callback(
+            lambda f: self.write_alerts(package_id, spool.name, f)
+        )
+
+    def write_alerts(self, package_id, path, future):
+        try:
+            if future.cancelled():
+                return
+            try:
+                _, alerts = future.result()
+            except (OSError, EOFError, ValueError, zlib.error) as e:
+                print(f"Unable to match package {package_id}: {e}")
+                return
+            if not alerts:
+                return
+            with self.lock:
+                write_oat_alerts(self.fd, alerts)
+            print(f"- alerts: package={package_id}, count={len(alerts)}")
+        finally:
+            os.unlink(path)
+            self.pending.release()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.fd.close()
 
 
 def main(args):
+    if args.request == "decode":
+        print(
+            f"request: {args.request}, "
+            f"args: bundles={args.bundles}, output_dir={args.output_dir}, "
+            f"risk_levels={args.risk_level}, techniques={args.technique}, "
+            f"endpoints={args.endpoint}, jobs={args.jobs}"
+        )
+        bundle_paths = sorted(
+            {p for pattern in args.bundles for p in glob.glob(pattern)}
+        )
+        if not bundle_paths:
+            raise ValueError("No bundle found")
+        read_count, written_count, error_count = decode_bundles(
+            bundle_paths, args.output_dir, args.risk_level, args.technique,
+            args.endpoint, args.jobs
+        )
+        print(
+            f"Decoded {len(bundle_paths) - error_count} bundles: "
+            f"{read_count} events, {written_count} written to "
+            f"{args.output_dir}"
+        )
+        if error_count:
+            print(f"Unable to decode {error_count} bundles")
+        return
+    if args.request == "match":
+        print(
+            f"request: {args.request}, "
+            f"args: rules={args.rules}, bundles={args.bundles}, "
+            f"alerts={args.alerts}, jobs={args.jobs}"
+        )
+        rules = load_oat_rules(args.rules)
+        bundle_paths = sorted(
+            {p for pattern in args.bundles for p in glob.glob(pattern)}
+        )
+        if not bundle_paths:
+            raise ValueError("No bundle found")
+        read_count, alert_count, error_count = match_bundles(
+            rules, bundle_paths, args.alerts, args.jobs
+        )
+        print(
+            f"Matched {len(bundle_paths) - error_count} bundles: "
+            f"{read_count} events, {alert_count} alerts written to "
+            f"{args.alerts}"
+        )
+        if error_count:
+            print(f"Unable to match {error_count} bundles")
+        return
+    if args.request == "extract-package":
+        print(
+            f"request: {args.request}, "
+            f"args: bundle={args.bundle}, "
+            f"package_id={args.package_id}, "
+            f"output={args.output}"
+        )
+        output_path = pathlib.Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with BundleReader(args.bundle) as reader:
+            package = reader.get_package(args.package_id)
+            with open(output_path, "wb") as fd:
+                fd.write(package)
+        print(f"saved package: {output_path}, size={len(package)}")
+        return
     url = args.url if args.url else V1_URL
     if args.token_path:
         with open(args.token_path) as fd:
@@ -314,7 +1796,9 @@ def main(args):
         token = V1_TOKEN
     else:
         raise ValueError("Authentication token missing")
-    client = TmV1Client(token, url)
+    client = TmV1Client(
+        token, url, getattr(args, "workers", V1_DOWNLOAD_WORKERS)
+    )
     if args.request == "register":
         print(
             f"request: {args.request}, "
@@ -360,6 +1844,27 @@ def main(args):
         )
         result = client.delete_datapipeline(pipeline_id_list=args.pipeline_id)
         print(json.dumps(result, indent=2))
+    elif args.request == "list-packages" and args.ndjson:
+        # packages are written to stdout as they are received, one JSON
+        # object per line, and the other messages to stderr
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            print(
+                f"request: {args.request}, args: "
+                f"pipeline_id={args.pipeline_id}, "
+                f"start_datetime={args.start_datetime}, "
+                f"end_datetime={args.end_datetime}, "
+                f"top={args.top}, next_link={args.next_link}"
+            )
+            for item in client.iter_datapipeline_packages(
+                pipeline_id=args.pipeline_id,
+                start_datetime=args.start_datetime,
+                end_datetime=args.end_datetime,
+                top=args.top,
+                next_link=args.next_link,
+            ):
+                stdout.write(json.dumps(item) + "\n")
+                stdout.flush()
     elif args.request == "list-packages":
         print(
             f"request: {args.request}, args: "
@@ -385,100 +1890,102 @@ def main(args):
         )
         output_path = pathlib.Path(args.output)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        result = client.get_datapipeline_package(
-            pipeline_id=args.pipeline_id, package_id=args.package_id
-        )
         with open(output_path, "wb") as fd:
-            fd.write(result)
+            size, checksum = client.download_datapipeline_package(
+                pipeline_id=args.pipeline_id, package_id=args.package_id,
+                fd=fd
+            )
+        print(f"saved package: {output_path}, size={size}, sha256={checksum}")
     elif args.request == "continuous-get-packages":
         output_path = pathlib.Path(args.output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
         signal.signal(signal.SIGINT, signal_int_handler)
         interval = args.interval
-        pipeline_id = args.pipeline_id
         if hasattr(args, 'batch_size'):
             max_items_batch = args.batch_size
         else:
             max_items_batch = 100
-        start_datetime = datetime.datetime.now(tz=datetime.timezone.utc)
-        end_datetime = start_datetime + datetime.timedelta(seconds=interval)
-        process_start = time.time()
-        print(
-            "start capturing..., next request is around: ",
-            end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        if args.pipeline_id == ["all"]:
+            pipeline_ids = [
+                p["id"] for p in client.get_datapipelines()["items"]
+            ]
+            if not pipeline_ids:
+                raise ValueError("No data pipeline registered")
+        else:
+            pipeline_ids = list(dict.fromkeys(args.pipeline_id))
+        single_pipeline = args.pipeline_id != ["all"] and (
+            len(pipeline_ids) == 1
         )
-        while CAPTURING:
-            if time.time() - process_start > interval:
-                start_time_str = (
-                    start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-                )
-                end_time_str = (
-                    end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-                )
-                print(
-                    f"Fetching packages for time window: "
-                    f"{start_time_str} to {end_time_str}"
-                )
-                pkg_response = client.get_datapipeline_packages(
-                    pipeline_id=pipeline_id,
-                    start_datetime=start_time_str,
-                    end_datetime=end_time_str,
-                    top=args.top
-                )
-                total_packages = len(pkg_response["items"])
-                print(f"Found {total_packages} packages to process")
+        if args.checkpoint and not single_pipeline:
+            raise ValueError(
+                "A checkpoint file can be specified for one pipeline only"
+            )
+        # package hooks are called by the download workers
+        package_hooks = []
+        alert_stage = None
+        if args.rules:
+            alert_stage = OatAlertStage(
+                load_oat_rules(args.rules),
+                args.alerts or output_path.joinpath("alerts.ndjson"),
+                args.match_jobs
+            )
+            package_hooks.append(alert_stage.add_package)
+        aggregator = None
+        if args.aggregate:
+            aggregator = OatAggregator(
+                args.aggregate, args.aggregate_interval, args.top_k
+            )
+            package_hooks.append(aggregator.add_package)
 
-                for batch_idx in range(0, total_packages, max_items_batch):
-                    batch_end = min(
-                        batch_idx + max_items_batch,
-                        total_packages
-                    )
-                    bundle_name = (
-                        f"bundle-{start_time_str}-{end_time_str}"
-                        f"-batch{batch_idx}-{batch_end}.gz"
-                    )
-                    bundle_path = output_path.joinpath(bundle_name)
-                    # Process this batch of packages
-                    batch_items = (
-                        pkg_response["items"][batch_idx:batch_end]
-                    )
-                    if batch_items:
-                        print(
-                            f"Processing batch "
-                            f"{batch_idx}-{batch_end} "
-                            f"of {total_packages} packages"
-                        )
-                        successful_packages = 0
-                        with open(bundle_path, "wb") as fd:
-                            for item in batch_items:
-                                package_id = item["id"]
-                                # Download the package
-                                package = (client.get_datapipeline_package(
-                                    pipeline_id=pipeline_id,
-                                    package_id=package_id
-                                ))
-                                fd.write(package)
-                                successful_packages += 1
-                                print(
-                                    f"- saved package: "
-                                    f"{package_id}"
-                                )
-                        print(
-                            f"Batch complete: {successful_packages}"
-                            f"successful packages"
-                        )
-                        print(f"Saved to bundle: {bundle_path}")
-                start_datetime = end_datetime
-                end_datetime = (
-                    start_datetime + datetime.timedelta(seconds=interval)
-                )
-                process_start = time.time()
-                print(
-                    f"Next time window: "
-                    f"{start_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')} "
-                    f"to {end_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+        def call_package_hooks(package_id, fd):
+            for hook in package_hooks:
+                fd.seek(0)
+                hook(package_id, fd)
+
+        on_package = call_package_hooks if package_hooks else None
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        try:
+            if single_pipeline:
+                capture_pipeline(
+                    client, pipeline_ids[0], output_path, args.checkpoint,
+                    interval, args.top, max_items_batch, pool, args.workers,
+                    on_package
                 )
-            time.sleep(3)
+            else:
+                # each pipeline has its own output directory and checkpoint
+                # and shares the client, rate limiter and download workers.
+                # A failed pipeline stops the others and fails the capture.
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(pipeline_ids)
+                ) as pipelines:
+                    futures = {
+                        pipelines.submit(
+                            capture_pipeline, client, pipeline_id,
+                            output_path.joinpath(pipeline_id), None,
+                            interval, args.top, max_items_batch, pool,
+                            args.workers, on_package
+                        ): pipeline_id
+                        for pipeline_id in pipeline_ids
+                    }
+                    errors = []
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception as e:
+                            STOP_CAPTURING.set()
+                            print(f"Pipeline {futures[future]} failed: {e}")
+                            errors.append(e)
+                if errors:
+                    raise RuntimeError(
+                        f"Capture failed for {len(errors)} pipelines"
+                    ) from errors[0]
+        finally:
+            STOP_CAPTURING.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            if alert_stage is not None:
+                alert_stage.close()
+            if aggregator is not None:
+                aggregator.close()
         print("Capture process terminated")
 
 
@@ -545,6 +2052,11 @@ if __name__ == "__main__":
         "-l", "--next-link",
         help="nextLink from previous response for list next page"
     )
+    list_packages_parser.add_argument(
+        "--ndjson", action="store_true",
+        help="Write each package to stdout as one JSON line as soon as "
+             "its page is received"
+    )
     get_package_parser = request_parsers.add_parser("get-package")
     get_package_parser.add_argument("pipeline_id", help="Pipeline ID")
     get_package_parser.add_argument("package_id", help="Package ID")
@@ -554,7 +2066,12 @@ if __name__ == "__main__":
         help="Continuously retrieve packages at regular intervals. "
              "To stop the process, press 'Ctrl+C'."
     )
-    cont_get_package_parser.add_argument("pipeline_id", help="Pipeline ID")
+    cont_get_package_parser.add_argument(
+        "pipeline_id", nargs="+",
+        help='Pipeline ID(s), or "all" for all registered pipelines. '
+             "Each pipeline is saved to a subdirectory named after its ID "
+             "when several pipelines are captured"
+    )
     cont_get_package_parser.add_argument(
         "-v", "--interval",
         type=int, default=180
@@ -572,5 +2089,106 @@ if __name__ == "__main__":
         type=int, default=100,
         help="Maximum number of packages to process in a single batch"
     )
+    cont_get_package_parser.add_argument(
+        "-w", "--workers",
+        type=int, default=V1_DOWNLOAD_WORKERS,
+        help="Number of packages downloaded at the same time, "
+             "shared by all the captured pipelines"
+    )
+    cont_get_package_parser.add_argument(
+        "-k", "--checkpoint",
+        help="Checkpoint file used to resume capturing after a restart. "
+             "Default: <output_dir>/checkpoint.json"
+    )
+    cont_get_package_parser.add_argument(
+        "-a", "--aggregate",
+        help="JSON file of running counts of the captured OAT events by "
+             "risk level, MITRE technique and endpoint"
+    )
+    cont_get_package_parser.add_argument(
+        "--aggregate-interval",
+        type=int, default=60,
+        help="Seconds between updates of the aggregate file"
+    )
+    cont_get_package_parser.add_argument(
+        "--top-k",
+        type=int, default=20,
+        help="Number of MITRE techniques and endpoints with the highest "
+             "counts kept in the aggregate file"
+    )
+    cont_get_package_parser.add_argument(
+        "-r", "--rules",
+        help="JSON file of detection rules matched against the OAT events "
+             "of each package as soon as it is downloaded"
+    )
+    cont_get_package_parser.add_argument(
+        "--alerts",
+        help="NDJSON file the alerts of the rules are appended to. "
+             "Default: <output_dir>/alerts.ndjson"
+    )
+    cont_get_package_parser.add_argument(
+        "--match-jobs", type=int,
+        help="Number of processes matching the rules. "
+             "Default: number of CPUs"
+    )
+    decode_parser = request_parsers.add_parser(
+        "decode",
+        help="Decode the OAT events of bundles or packages into NDJSON.gz "
+             "files partitioned by detection date and risk level"
+    )
+    decode_parser.add_argument(
+        "bundles", nargs="+",
+        help="Bundle or package file paths or glob patterns"
+    )
+    decode_parser.add_argument(
+        "-o", "--output-dir", required=True,
+        help="Output directory path"
+    )
+    decode_parser.add_argument(
+        "-r", "--risk-level", action="append", choices=OAT_RISK_LEVELS,
+        help="Keep events matching a filter of this risk level "
+             "(can specify multiple)"
+    )
+    decode_parser.add_argument(
+        "-m", "--technique", action="append",
+        help="Keep events matching a filter of this MITRE technique ID, "
+             "including its sub-techniques (can specify multiple)"
+    )
+    decode_parser.add_argument(
+        "-e", "--endpoint", action="append",
+        help="Keep events of this endpoint name, agent GUID or IP "
+             "(can specify multiple)"
+    )
+    decode_parser.add_argument(
+        "-j", "--jobs", type=int,
+        help="Number of bundles decoded at the same time. "
+             "Default: number of CPUs"
+    )
+    match_parser = request_parsers.add_parser(
+        "match",
+        help="Match the OAT events of bundles or packages against "
+             "detection rules and append the alerts to an NDJSON file"
+    )
+    match_parser.add_argument("rules", help="JSON rules file path")
+    match_parser.add_argument(
+        "bundles", nargs="+",
+        help="Bundle or package file paths or glob patterns"
+    )
+    match_parser.add_argument(
+        "-o", "--alerts", required=True,
+        help="NDJSON alerts file path"
+    )
+    match_parser.add_argument(
+        "-j", "--jobs", type=int,
+        help="Number of bundles matched at the same time. "
+             "Default: number of CPUs"
+    )
+    extract_package_parser = request_parsers.add_parser(
+        "extract-package",
+        help="Extract a package from a bundle using the bundle index"
+    )
+    extract_package_parser.add_argument("bundle", help="Bundle file path")
+    extract_package_parser.add_argument("package_id", help="Package ID")
+    extract_package_parser.add_argument("output", help="Output file path")
     _args = parser.parse_args()
     main(_args)
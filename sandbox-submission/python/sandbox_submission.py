@@ -1,8 +1,25 @@
 import os
 import sys
+import glob
+import json
+import heapq
 import base64
 import time
+import random
+import itertools
+import collections
+import sqlite3
+import hashlib
+import mmap
+import bisect
+import tempfile
+import shutil
+import zipfile
+import tarfile
+import urllib.parse
 import argparse
+import threading
+import concurrent.futures
 
 import requests
 
@@ -18,9 +35,45 @@ V1_URL = os.environ.get('TMV1_URL', 'https://api.xdr.trendmicro.com')
 V1_UA = os.environ.get('TMV1_UA', 'Trend Vision One API Cookbook '
                        f'({os.path.basename(__file__)})')
 V1_WAIT_TASK_INTERVAL = int(os.environ.get('TMV1_WAIT_TASK_INTERVAL', 10))
-V1_WAIT_TASK_RETRY = int(os.environ.get('TMV1_WAIT_TASK_RETRY', 12))
+# Tasks are polled at least every V1_WAIT_TASK_INTERVAL seconds and at most
+# every V1_WAIT_TASK_INTERVAL_MAX seconds depending on the observed analysis
+# durations. Tasks still running after V1_WAIT_TASK_TIMEOUT seconds are
+# reported as not finished.
+V1_WAIT_TASK_INTERVAL_MAX = int(
+    os.environ.get('TMV1_WAIT_TASK_INTERVAL_MAX', 60)
+)
+V1_WAIT_TASK_TIMEOUT = int(os.environ.get('TMV1_WAIT_TASK_TIMEOUT', 1800))
+# Maximum number of IDs in the filter of one task list request, and maximum
+# number of requests sent concurrently
+V1_FILTER_CHUNK_SIZE = int(os.environ.get('TMV1_FILTER_CHUNK_SIZE', 50))
+V1_MAX_WORKERS = int(os.environ.get('TMV1_MAX_WORKERS', 4))
 V1_ANALYZE_INTERVAL = int(os.environ.get('TMV1_ANALYZE_INTERVAL', 300))
 V1_ANALYZE_RETRY = int(os.environ.get('TMV1_ANALYZE_RETRY', 3))
+# Failed analyses are retried after V1_ANALYZE_BACKOFF seconds, doubled for
+# each retry up to V1_ANALYZE_INTERVAL seconds. Other submissions keep
+# running while the failed ones wait.
+V1_ANALYZE_BACKOFF = int(os.environ.get('TMV1_ANALYZE_BACKOFF', 30))
+# Maximum number of URLs in one submission request
+V1_URL_CHUNK_SIZE = int(os.environ.get('TMV1_URL_CHUNK_SIZE', 10))
+# Maximum number of analysis reports downloaded at the same time
+V1_DOWNLOAD_WORKERS = int(os.environ.get('TMV1_DOWNLOAD_WORKERS', 4))
+# Number of submissions after which the remaining daily reserve is checked
+# again when submitting several files
+V1_QUOTA_RECHECK = int(os.environ.get('TMV1_QUOTA_RECHECK', 10))
+# SQLite file of analysis results keyed by file SHA-256 or normalized URL.
+# Cached results newer than V1_VERDICT_TTL seconds are used instead of
+# submitting the same object again.
+#   default: "" (cache disabled)
+V1_VERDICT_CACHE = os.environ.get('TMV1_VERDICT_CACHE', '')
+V1_VERDICT_TTL = int(os.environ.get('TMV1_VERDICT_TTL', 7 * 86400))
+# Archives expanding to more than V1_ARCHIVE_MAX_MEMBERS members, more than
+# V1_ARCHIVE_MAX_SIZE bytes or more than V1_ARCHIVE_MAX_RATIO times their
+# own size are submitted as they are
+V1_ARCHIVE_MAX_MEMBERS = int(os.environ.get('TMV1_ARCHIVE_MAX_MEMBERS', 1000))
+V1_ARCHIVE_MAX_SIZE = int(
+    os.environ.get('TMV1_ARCHIVE_MAX_SIZE', 1024 * 1024 * 1024)
+)
+V1_ARCHIVE_MAX_RATIO = int(os.environ.get('TMV1_ARCHIVE_MAX_RATIO', 100))
 
 
 def is_container(v):
@@ -86,6 +139,31 @@ class TmV1Client:
         raise RuntimeError(f'Request unsuccessful (GET {url_or_path}):'
                            f' {r.status_code} {r.text}')
 
+    def download(self, url_or_path, dest, use_token=True,
+                 chunk_size=1 << 16, **kwargs):
+        # write to a partial file so that dest only appears when complete
+        kwargs.setdefault('headers', {}).update(
+            self.make_headers(use_token=use_token)
+        )
+        url = (self.base_url + url_or_path if url_or_path.startswith('/') else
+               url_or_path)
+        part = dest + '.part'
+        try:
+            with requests.get(url, stream=True, **kwargs) as r:
+                if 200 != r.status_code:
+                    raise RuntimeError('Request unsuccessful'
+                                       f' (GET {url_or_path}):'
+                                       f' {r.status_code} {r.text}')
+                with open(part, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk)
+            os.replace(part, dest)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        return dest
+
     def post(self, path, **kwargs):
         kwargs.setdefault('headers', {}).update(self.make_headers(**kwargs))
         r = requests.post(self.base_url + path, **kwargs)
@@ -112,6 +190,27 @@ class TmV1Client:
             next_link = r['nextLink']
         return items
 
+    def get_items_by_ids(self, path, ids, name='id', **kwargs):
+        ids = list(ids)
+        chunks = [ids[i:i+V1_FILTER_CHUNK_SIZE]
+                  for i in range(0, len(ids), V1_FILTER_CHUNK_SIZE)]
+
+        def get_chunk(chunk):
+            params = dict(kwargs.get('params', {}))
+            params['filter'] = get_filter_arg(name, chunk)
+            return self.get_items(path, **{
+                **kwargs, 'params': params,
+                'headers': dict(kwargs.get('headers', {}))
+            })
+
+        items = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(V1_MAX_WORKERS, len(chunks)))
+        ) as executor:
+            for r in executor.map(get_chunk, chunks):
+                items.update((item[name], item) for item in r)
+        return [items[v] for v in ids if v in items]
+
     def get_from_post_response(self, status_code, headers, body):
         if (201 == status_code) and ('Location' in headers):
             return self.get(headers['Location'])
@@ -171,44 +270,352 @@ class TmV1Client:
         return self.post_multiple('/v3.0/sandbox/urls/analyze', json=request)
 
     def get_sandbox_tasks(self, ids=None):
-        params = {}
         if ids is not None:
-            params['filter'] = get_filter_arg('id', ids)
-        return self.get_items('/v3.0/sandbox/tasks', params=params)
+            return self.get_items_by_ids('/v3.0/sandbox/tasks', ids)
+        return self.get_items('/v3.0/sandbox/tasks')
 
     def get_sandbox_analysis_result(self, analysis_result_id):
         return self.get(f'/v3.0/sandbox/analysisResults/{analysis_result_id}')
 
-    def get_sandbox_analysis_report(self, analysis_result_id):
-        return self.get(
-            f'/v3.0/sandbox/analysisResults/{analysis_result_id}/report'
+    def download_sandbox_analysis_report(self, analysis_result_id, dest):
+        return self.download(
+            f'/v3.0/sandbox/analysisResults/{analysis_result_id}/report', dest
         )
 
 
-def wait_sandbox_tasks(v1, tasks):
-    count = 0
-    while True:
-        running_task_indexes = [
-            i for i, t in enumerate(tasks)
-            if t and ('running' == t['status'])
+class SubmissionQuota:
+    def __init__(self, v1, recheck=V1_QUOTA_RECHECK):
+        self.v1 = v1
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.count = 0
+
+    def refresh(self):
+        r = self.v1.get_sandbox_sumbission_usage()
+        self.remaining = r['submissionRemainingCount']
+        self.count = 0
+        return self.remaining
+
+    def acquire(self):
+        with self.lock:
+            if (self.remaining is None) or not (self.count < self.recheck):
+                self.refresh()
+            if not (0 < self.remaining):
+                return False
+            self.remaining -= 1
+            self.count += 1
+            return True
+
+
+def get_quota_exceeded_response():
+    return {'body': {'error': {
+        'code': 'SubmissionQuotaExceeded',
+        'message': 'No submissions available in the daily reserve'
+    }}}
+
+
+def get_submission_error_response(e):
+    return {'body': {'error': {
+        'code': 'SubmissionFailed',
+        'message': str(e)
+    }}}
+
+
+def expand_file_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.extend(os.path.join(root, f) for f in sorted(files))
+            continue
+        paths.extend(p for p in sorted(glob.glob(pattern, recursive=True))
+                     if os.path.isfile(p))
+    # remove duplicates and keep the order
+    return list(dict.fromkeys(paths))
+
+
+def get_file_hashes(file_obj):
+    file_obj.seek(0)
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(1 << 20), b''):
+        sha1.update(chunk)
+        sha256.update(chunk)
+    file_obj.seek(0)
+    return sha1.hexdigest(), sha256.hexdigest()
+
+
+def get_file_sha256(file_obj):
+    return get_file_hashes(file_obj)[1]
+
+
+def get_file_cache_key(sha256, archive_password=None, document_password=None):
+    # the result of a protected file depends on the passwords it was
+    # analyzed with, which are hashed so that the cache does not keep them
+    key = 'sha256:' + sha256
+    if archive_password or document_password:
+        passwords = f'{archive_password or ""}\0{document_password or ""}'
+        key += ':' + hashlib.sha256(passwords.encode()).hexdigest()
+    return key
+
+
+class SortedHashIndex:
+    # Sorted fixed-size binary digests in a memory-mapped file, built once
+    # next to the text hash list. Unlike a Bloom filter, lookups have no
+    # false positives, so unknown files are never skipped.
+    digest_names = {20: 'sha1', 32: 'sha256'}
+
+    def __init__(self, path, digest_size):
+        self.digest_size = digest_size
+        index_path = f'{path}.{self.digest_names[digest_size]}.idx'
+        if ((not os.path.exists(index_path)) or
+                (os.path.getmtime(index_path) < os.path.getmtime(path))):
+            self.build(path, index_path, digest_size)
+        self.count = os.path.getsize(index_path) // digest_size
+        self.map = None
+        if self.count:
+            with open(index_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Number of digests sorted in memory at a time while building
+    chunk_digests = 1 << 20
+
+    @staticmethod
+    def iter_file_digests(f, digest_size):
+        return iter(lambda: f.read(digest_size), b'')
+
+    @classmethod
+    def build(cls, path, index_path, digest_size):
+        # Digests are sorted in chunks written to temporary files, which
+        # are then merged, so that large lists are not loaded in memory.
+        runs = []
+
+        def write_run(chunk):
+            run = tempfile.TemporaryFile()
+            run.write(b''.join(sorted(set(chunk))))
+            run.seek(0)
+            runs.append(run)
+
+        try:
+            chunk = []
+            with open(path) as f:
+                for line in f:
+                    token = line.replace(',', ' ').split(maxsplit=1)
+                    if not token or (len(token[0]) != digest_size * 2):
+                        continue
+                    try:
+                        chunk.append(bytes.fromhex(token[0]))
+                    except ValueError:
+                        continue
+                    if len(chunk) >= cls.chunk_digests:
+                        write_run(chunk)
+                        chunk = []
+            if chunk:
+                write_run(chunk)
+            previous = None
+            with open(index_path + '.part', 'wb') as f:
+                for d in heapq.merge(*(cls.iter_file_digests(run, digest_size)
+                                       for run in runs)):
+                    if d != previous:
+                        f.write(d)
+                        previous = d
+            os.replace(index_path + '.part', index_path)
+        finally:
+            for run in runs:
+                run.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = i * self.digest_size
+        return self.map[offset:offset + self.digest_size]
+
+    def __contains__(self, digest):
+        if not self.count:
+            return False
+        i = bisect.bisect_left(self, digest)
+        return (i < self.count) and (self[i] == digest)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+class KnownHashes:
+    def __init__(self, allowlists=(), blocklists=()):
+        self.lists = [
+            (name, SortedHashIndex(path, 20), SortedHashIndex(path, 32))
+            for name, paths in [('blocklist', blocklists),
+                                ('allowlist', allowlists)]
+            for path in paths
         ]
-        if not running_task_indexes:
-            break
-        if not (count < V1_WAIT_TASK_RETRY):
-            break
-        count += 1
-        print((f'Tasks running: {len(running_task_indexes)}; '
-               f'Waiting interval (seconds): {V1_WAIT_TASK_INTERVAL}; '
-               f'Number of intervals: {count}.'))
-        time.sleep(V1_WAIT_TASK_INTERVAL)
-        response = v1.get_sandbox_tasks([tasks[i]['id']
-                                         for i in running_task_indexes])
-        for i, r in enumerate(response):
-            tasks[running_task_indexes[i]].update(r)
-    finished = not running_task_indexes
-    if not finished:
-        print('Tasks not finished')
-    return finished
+
+    def close(self):
+        for _, sha1, sha256 in self.lists:
+            sha1.close()
+            sha256.close()
+
+    def find(self, sha1, sha256):
+        # blocklists are checked first
+        sha1 = bytes.fromhex(sha1)
+        sha256 = bytes.fromhex(sha256)
+        for name, sha1_index, sha256_index in self.lists:
+            if (sha1 in sha1_index) or (sha256 in sha256_index):
+                return name
+
+
+def get_known_hash_result(name, list_name):
+    risk_level = 'high' if 'blocklist' == list_name else 'noRisk'
+    return (name, None, {'status': f'{list_name}ed'},
+            {'riskLevel': risk_level}, None)
+
+
+RISK_LEVELS = ['noRisk', 'low', 'medium', 'high']
+
+# 7z is not supported by the standard library, so such archives are always
+# submitted as they are
+ARCHIVE_EXTENSIONS = {
+    '.zip': 'zip',
+    '.tar': 'tar',
+    '.tar.gz': 'tar',
+    '.tgz': 'tar',
+    '.tar.bz2': 'tar',
+    '.tbz2': 'tar',
+    '.tar.xz': 'tar',
+    '.txz': 'tar',
+}
+
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, RuntimeError,
+                  NotImplementedError, EOFError, OSError, ValueError)
+
+
+def get_archive_type(name):
+    # only the name is checked, so that documents stored as zip files such
+    # as docx are analyzed as documents
+    name = name.lower()
+    for ext, archive_type in ARCHIVE_EXTENSIONS.items():
+        if name.endswith(ext):
+            return archive_type
+
+
+def iter_archive_members(archive_type, infile, password=None,
+                         max_members=V1_ARCHIVE_MAX_MEMBERS):
+    # yields (member name, file object) one member at a time
+    count = itertools.count(1)
+
+    def count_member():
+        if next(count) > max_members:
+            raise ValueError(f'more than {max_members} members')
+    infile.seek(0)
+    if 'zip' == archive_type:
+        with zipfile.ZipFile(infile) as z:
+            if password:
+                z.setpassword(password.encode())
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                count_member()
+                with z.open(info) as f:
+                    yield info.filename, f
+        return
+    with tarfile.open(fileobj=infile, mode='r:*') as t:
+        for member in t:
+            if member.isfile():
+                count_member()
+                yield member.name, t.extractfile(member)
+
+
+def copy_file_hashes(infile, outfile, max_size=None):
+    # raises ValueError once more than max_size bytes are read
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: infile.read(1 << 20), b''):
+        size += len(chunk)
+        if (max_size is not None) and (size > max_size):
+            raise ValueError(f'more than {max_size} bytes expanded')
+        sha1.update(chunk)
+        sha256.update(chunk)
+        outfile.write(chunk)
+    outfile.seek(0)
+    return sha1.hexdigest(), sha256.hexdigest()
+
+
+def get_archive_result(name, members):
+    # the archive is as risky as its riskiest member
+    def risk(r):
+        result = r[3] or {}
+        return RISK_LEVELS.index(result.get('riskLevel', 'noRisk'))
+    r = max(members, key=risk)
+    return (name, None, *r[2:])
+
+
+def normalize_url(url):
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = {'http': ':80', 'https': ':443'}.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return urllib.parse.urlunsplit(
+        (scheme, netloc, parts.path or '/', parts.query, '')
+    )
+
+
+def get_unique_urls(url):
+    # keep the first of the URLs that are the same after normalization
+    unique = {}
+    for u in url:
+        unique.setdefault(normalize_url(u), u)
+    return list(unique.values())
+
+
+class VerdictCache:
+    def __init__(self, path, ttl=V1_VERDICT_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                              'key TEXT PRIMARY KEY,'
+                              ' risk_level TEXT,'
+                              ' task TEXT NOT NULL,'
+                              ' result TEXT NOT NULL,'
+                              ' report_path TEXT,'
+                              ' cached_at REAL NOT NULL)')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT task, result, report_path FROM verdicts'
+                ' WHERE key = ? AND cached_at > ?',
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        task, result, report_path = row
+        if report_path and not os.path.exists(report_path):
+            report_path = None
+        return json.loads(task), json.loads(result), report_path
+
+    def put(self, key, task, result, report_path=None):
+        if report_path:
+            report_path = os.path.abspath(report_path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO verdicts (key, risk_level, task,'
+                ' result, report_path, cached_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, result.get('riskLevel'), json.dumps(task),
+                 json.dumps(result), report_path, time.time())
+            )
 
 
 def fetch_analysis_result(v1, task):
@@ -220,11 +627,8 @@ def fetch_analysis_result(v1, task):
 def fetch_analysis_report(v1, result, file_name_prefix):
     id_ = result['id']
     if result['riskLevel'] in ['high', 'medium', 'low']:
-        response = v1.get_sandbox_analysis_report(id_)
         dest_name = f'{file_name_prefix}_{id_}.pdf'
-        with open(dest_name, 'wb') as f:
-            f.write(response)
-        return dest_name
+        return v1.download_sandbox_analysis_report(id_, dest_name)
 
 
 def need_retry(task):
@@ -232,76 +636,582 @@ def need_retry(task):
         return 'InternalServerError' == task['error']['code']
 
 
-def analyze_file(v1, infile, name, archive_password, document_password):
-    file_name_prefix = 'sandbox_analysis_file'
-    count = 0
-    while True:
-        status_code, headers, response = v1.analyze_file(
-            infile, name, archive_password, document_password
+def get_retry_delay(count):
+    # exponential backoff capped by V1_ANALYZE_INTERVAL with jitter so that
+    # failed submissions are not retried all at once
+    delay = min(V1_ANALYZE_INTERVAL, V1_ANALYZE_BACKOFF * (2 ** count))
+    return random.uniform(delay / 2, delay)
+
+
+class RetryScheduler:
+    def __init__(self, max_workers=V1_MAX_WORKERS):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
         )
-        task = v1.get_from_post_response(status_code, headers, response)
-        if task is None:
-            return (name, response, None, None, None)
-        wait_sandbox_tasks(v1, [task])
-        result = fetch_analysis_result(v1, task)
-        if result is None:
-            if not (need_retry(task) and (count < V1_ANALYZE_RETRY)):
-                return (name, response, task, None, None)
-            count += 1
-            time.sleep(V1_ANALYZE_INTERVAL)
-            continue
-        file_name = fetch_analysis_report(v1, result, file_name_prefix)
-        if file_name is None:
-            return (name, response, task, result, None)
-        return (name, response, task, result, file_name)
+        self.condition = threading.Condition()
+        # delayed jobs ordered by due time
+        self.queue = []
+        self.sequence = itertools.count()
+        self.pending = 0
+        self.errors = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
+    def schedule(self, delay, fn, *args):
+        with self.condition:
+            self.pending += 1
+            heapq.heappush(self.queue, (time.monotonic() + delay,
+                                        next(self.sequence), fn, args))
+            self.condition.notify_all()
 
-def analyze_urls(v1, url):
-    r = []
-    file_name_prefix = 'sandbox_analysis_url'
-    count = 0
-    while True:
-        response = v1.analyze_url(url)
-        tasks = v1.get_from_post_multiple_response(response)
-        wait_sandbox_tasks(v1, tasks)
-
-        url = []
-        for (req, res), task in zip(response, tasks):
-            name = req['url']
-            if task is None:
-                r.append((name, res, None, None, None))
+    # hold and release count work done outside of the scheduler, such as
+    # tasks being polled, so that join waits for it
+    def hold(self):
+        with self.condition:
+            self.pending += 1
+
+    def release(self):
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def fail(self, e):
+        with self.condition:
+            self.errors.append(e)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    now = time.monotonic()
+                    if self.queue and (self.queue[0][0] <= now):
+                        _, _, fn, args = heapq.heappop(self.queue)
+                        break
+                    timeout = (self.queue[0][0] - now) if self.queue else None
+                    self.condition.wait(timeout)
+            self.executor.submit(self.execute, fn, args)
+
+    def execute(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.pending and not self.errors:
+                self.condition.wait()
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.errors:
+            raise self.errors[0]
+
+
+class SandboxTaskPoller:
+    def __init__(self, v1, timeout=V1_WAIT_TASK_TIMEOUT, on_error=None):
+        self.v1 = v1
+        self.timeout = timeout
+        self.on_error = on_error
+        self.condition = threading.Condition()
+        # running tasks by ID: (task, time added, callback)
+        self.tasks = {}
+        # smoothed analysis duration observed in this run
+        self.duration = None
+        self.count = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, task, callback):
+        if 'running' != task['status']:
+            callback(task)
+            return
+        with self.condition:
+            self.tasks[task['id']] = (task, time.monotonic(), callback)
+            self.condition.notify_all()
+
+    def get_interval(self):
+        # poll about four times during a typical analysis
+        if self.duration is None:
+            return V1_WAIT_TASK_INTERVAL
+        return max(V1_WAIT_TASK_INTERVAL,
+                   min(V1_WAIT_TASK_INTERVAL_MAX, self.duration / 4))
+
+    def add_duration(self, duration):
+        if self.duration is None:
+            self.duration = duration
+        else:
+            self.duration = 0.8 * self.duration + 0.2 * duration
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.tasks or self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                interval = self.get_interval()
+                self.count += 1
+                print(f'Tasks running: {len(self.tasks)}; '
+                      f'Waiting interval (seconds): {interval:.0f}; '
+                      f'Number of intervals: {self.count}.')
+                next_poll = time.monotonic() + interval
+                while not self.closed and (time.monotonic() < next_poll):
+                    self.condition.wait(next_poll - time.monotonic())
+                if self.closed:
+                    return
+                ids = list(self.tasks)
+            try:
+                response = dict((r['id'], r)
+                                for r in self.v1.get_sandbox_tasks(ids))
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(e)
                 continue
-            result = fetch_analysis_result(v1, task)
-            if result is None:
-                if need_retry(task):
-                    # set to url to be retried
-                    url.append(req['url'])
-                else:
-                    r.append((name, res, task, None, None))
+            now = time.monotonic()
+            finished = []
+            with self.condition:
+                for id_ in ids:
+                    task, added, callback = self.tasks[id_]
+                    task.update(response.get(id_, {}))
+                    if 'running' != task['status']:
+                        self.add_duration(now - added)
+                    elif now - added < self.timeout:
+                        continue
+                    del self.tasks[id_]
+                    finished.append((callback, task))
+            for callback, task in finished:
+                callback(task)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class SandboxAnalyzer:
+    def __init__(self, v1, quota=None, cache=None,
+                 max_workers=V1_MAX_WORKERS, on_result=None,
+                 known_hashes=None, expand_archives=False, max_running=None):
+        self.v1 = v1
+        self.quota = quota
+        self.cache = cache
+        self.known_hashes = known_hashes
+        self.expand_archives = expand_archives
+        self.on_result = on_result
+        self.scheduler = RetryScheduler(max_workers)
+        self.poller = SandboxTaskPoller(v1, on_error=self.scheduler.fail)
+        # reports are downloaded by their own workers so that large reports
+        # do not hold up submissions and polling
+        self.downloader = concurrent.futures.ThreadPoolExecutor(
+            max_workers=V1_DOWNLOAD_WORKERS
+        )
+        # At most max_running files are analyzed at the same time. A file
+        # takes a slot when it is scheduled and gives it back when its task
+        # is no longer running, or when it is not submitted, and the next
+        # waiting file is then scheduled, so that workers never wait for a
+        # slot.
+        self.slots = max_running
+        self.waiting = collections.deque()
+        self.slot_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.results = []
+
+    def add_result(self, order, r, member=0):
+        # results of archive members follow the result of their archive
+        with self.lock:
+            self.results.append(((order, member), r))
+            if self.on_result is not None:
+                self.on_result(r)
+
+    def join(self):
+        try:
+            self.scheduler.join()
+        finally:
+            self.poller.close()
+            self.downloader.shutdown(wait=True, cancel_futures=True)
+        return [r for _, r in sorted(self.results, key=lambda x: x[0])]
+
+    def wait_task(self, task, fn, *args, on_done=None):
+        # fn(*args, task) is scheduled when the task is no longer running
+        def callback(t):
+            self.scheduler.schedule(0, fn, *args, t)
+            if on_done is not None:
+                on_done()
+            self.scheduler.release()
+
+        self.scheduler.hold()
+        self.poller.add(task, callback)
+
+    def download(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                self.scheduler.fail(e)
+            finally:
+                self.scheduler.release()
+
+        self.scheduler.hold()
+        self.downloader.submit(run)
+
+    def submit_file(self, source, name, archive_password=None,
+                    document_password=None):
+        # source is a path or a seekable file object
+        self.schedule_file(0, next(self.sequence), source, name,
+                           archive_password, document_password, 0)
+
+    def schedule_file(self, delay, *args):
+        # args are the arguments of analyze_file
+        with self.slot_lock:
+            if self.slots is not None:
+                if not (0 < self.slots):
+                    # held until a slot is released
+                    self.scheduler.hold()
+                    self.waiting.append((delay, args))
+                    return
+                self.slots -= 1
+        self.scheduler.schedule(delay, self.analyze_file, *args)
+
+    def release_slot(self):
+        with self.slot_lock:
+            if self.slots is None:
+                return
+            if not self.waiting:
+                self.slots += 1
+                return
+            delay, args = self.waiting.popleft()
+        # the slot goes to the next waiting file
+        self.scheduler.schedule(delay, self.analyze_file, *args)
+        self.scheduler.release()
+
+    def submit_urls(self, url):
+        orders = []
+        not_cached = []
+        for u in get_unique_urls(url):
+            order = next(self.sequence)
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get('url:' + normalize_url(u))
+            if cached is not None:
+                self.add_result(order, (u, None, *cached))
                 continue
-            dest_name = fetch_analysis_report(v1, result, file_name_prefix)
-            if dest_name is None:
-                r.append((name, res, task, result, None))
+            orders.append(order)
+            not_cached.append(u)
+        # chunks are submitted in parallel and their tasks polled together
+        for i in range(0, len(not_cached), V1_URL_CHUNK_SIZE):
+            self.scheduler.schedule(0, self.analyze_urls,
+                                    orders[i:i+V1_URL_CHUNK_SIZE],
+                                    not_cached[i:i+V1_URL_CHUNK_SIZE], 0)
+
+    def analyze_file(self, order, source, name, archive_password,
+                     document_password, count, member_keys=None):
+        started = False
+        try:
+            if isinstance(source, str):
+                with open(source, 'rb') as infile:
+                    started = self.analyze_file_object(
+                        order, source, infile, name, archive_password,
+                        document_password, count, member_keys
+                    )
+            else:
+                started = self.analyze_file_object(
+                    order, source, source, name, archive_password,
+                    document_password, count, member_keys
+                )
+        finally:
+            # the slot of a started task is released by the poller
+            if not started:
+                if member_keys is not None:
+                    source.close()
+                self.release_slot()
+
+    def find_known_file(self, name, sha1, sha256, archive_password=None,
+                        document_password=None):
+        if self.known_hashes is not None:
+            list_name = self.known_hashes.find(sha1, sha256)
+            if list_name is not None:
+                return get_known_hash_result(name, list_name)
+        if self.cache is not None:
+            cached = self.cache.get(get_file_cache_key(
+                sha256, archive_password, document_password
+            ))
+            if cached is not None:
+                return (name, None, *cached)
+
+    def analyze_archive(self, order, infile, name, archive_type,
+                        archive_password, document_password):
+        # Members already known are reported from the cache or hash lists,
+        # and only the others are repacked into a new zip archive and
+        # submitted. Returns None if the archive cannot be expanded, else
+        # whether a task was started.
+        seen = set()
+        known = []
+        member_keys = []
+        # bytes that may still be expanded, so that decompression bombs
+        # are submitted as they are
+        available = min(V1_ARCHIVE_MAX_SIZE,
+                        V1_ARCHIVE_MAX_RATIO * infile.seek(0, os.SEEK_END))
+        repack = tempfile.TemporaryFile()
+        try:
+            with zipfile.ZipFile(repack, 'w', zipfile.ZIP_DEFLATED) as z:
+                for member_name, f in iter_archive_members(
+                        archive_type, infile, archive_password):
+                    with tempfile.TemporaryFile() as spool:
+                        sha1, sha256 = copy_file_hashes(f, spool, available)
+                        available -= spool.seek(0, os.SEEK_END)
+                        spool.seek(0)
+                        if sha256 in seen:
+                            continue
+                        seen.add(sha256)
+                        # members are submitted in a repacked archive
+                        # without password
+                        r = self.find_known_file(f'{name}/{member_name}',
+                                                 sha1, sha256, None,
+                                                 document_password)
+                        if r is not None:
+                            known.append(r)
+                            continue
+                        member_keys.append(get_file_cache_key(
+                            sha256, None, document_password
+                        ))
+                        with z.open(member_name, 'w', force_zip64=True) as o:
+                            shutil.copyfileobj(spool, o)
+        except ARCHIVE_ERRORS as e:
+            print(f'Unable to expand "{name}", submitting it as it is: {e}')
+            repack.close()
+            return None
+        if not seen:
+            repack.close()
+            return None
+        for i, r in enumerate(known, 1):
+            self.add_result(order, r, i)
+        if not member_keys:
+            repack.close()
+            self.add_result(order, get_archive_result(name, known))
+            return False
+        if 'zip' != archive_type:
+            name += '.zip'
+        # the repacked archive is kept for retries until its task is
+        # complete
+        started = False
+        try:
+            started = self.analyze_file_object(order, repack, repack, name,
+                                               None, document_password, 0,
+                                               member_keys)
+        finally:
+            if not started:
+                repack.close()
+        return started
+
+    def analyze_file_object(self, order, source, infile, name,
+                            archive_password, document_password, count,
+                            member_keys=None):
+        # member_keys are the cache keys of the members of a repacked
+        # archive. Returns whether a task was started.
+        if self.expand_archives and (member_keys is None):
+            archive_type = get_archive_type(name)
+            if archive_type:
+                started = self.analyze_archive(
+                    order, infile, name, archive_type, archive_password,
+                    document_password
+                )
+                if started is not None:
+                    return started
+        key = None
+        if (self.cache is not None) or (self.known_hashes is not None):
+            sha1, sha256 = get_file_hashes(infile)
+            r = self.find_known_file(name, sha1, sha256, archive_password,
+                                     document_password)
+            if r is not None:
+                self.add_result(order, r)
+                return False
+        if self.cache is not None:
+            key = get_file_cache_key(sha256, archive_password,
+                                     document_password)
+        if (self.quota is not None) and not self.quota.acquire():
+            self.add_result(
+                order, (name, get_quota_exceeded_response(), None, None, None)
+            )
+            return False
+        # results are reported with the path, and files are uploaded
+        # with their base name only. A rejected file is reported and the
+        # other files are still submitted.
+        infile.seek(0)
+        try:
+            status_code, headers, response = self.v1.analyze_file(
+                infile, os.path.basename(name), archive_password,
+                document_password
+            )
+        except (RuntimeError, OSError) as e:
+            self.add_result(
+                order, (name, get_submission_error_response(e), None, None,
+                        None)
+            )
+            return False
+        task = self.v1.get_from_post_response(status_code, headers, response)
+        if task is None:
+            self.add_result(order, (name, response, None, None, None))
+            return False
+        self.wait_task(task, self.complete_file, order, source, name,
+                       archive_password, document_password, count, key,
+                       response, member_keys, on_done=self.release_slot)
+        return True
+
+    def complete_file(self, order, source, name, archive_password,
+                      document_password, count, key, response, member_keys,
+                      task):
+        result = fetch_analysis_result(self.v1, task)
+        if ((result is None) and need_retry(task) and
+                (count < V1_ANALYZE_RETRY)):
+            return self.schedule_file(
+                get_retry_delay(count), order, source, name,
+                archive_password, document_password, count + 1, member_keys
+            )
+        # the repacked archive of the members is no longer needed
+        if member_keys is not None:
+            source.close()
+        if result is None:
+            return self.add_result(order, (name, response, task, None, None))
+        keys = [key] if key is not None else []
+        # the result of a repacked archive applies to each of its members
+        # only if it has no risk or it has a single member
+        if (key is not None) and member_keys and (
+                ('noRisk' == result.get('riskLevel')) or
+                (1 == len(member_keys))):
+            keys += member_keys
+        self.download(self.save_report, order, keys, name, response, task,
+                      result, 'sandbox_analysis_file')
+
+    def analyze_urls(self, orders, url, count):
+        if self.quota is not None:
+            allowed = [self.quota.acquire() for _ in url]
+            for order, u, a in zip(orders, url, allowed):
+                if not a:
+                    self.add_result(order, (u, get_quota_exceeded_response(),
+                                            None, None, None))
+            orders = [o for o, a in zip(orders, allowed) if a]
+            url = [u for u, a in zip(url, allowed) if a]
+            if not url:
+                return
+        response = self.v1.analyze_url(url)
+        tasks = self.v1.get_from_post_multiple_response(response)
+        for order, (req, res), task in zip(orders, response, tasks):
+            if task is None:
+                self.add_result(order, (req['url'], res, None, None, None))
                 continue
-            r.append((name, res, task, result, dest_name))
-        if not url:
-            break
-        if not (count < V1_ANALYZE_RETRY):
-            break
-        count += 1
-        time.sleep(V1_ANALYZE_INTERVAL)
-    return r
+            self.wait_task(task, self.complete_url, order, req['url'], res,
+                           count)
+
+    def complete_url(self, order, name, res, count, task):
+        result = fetch_analysis_result(self.v1, task)
+        if result is None:
+            if need_retry(task) and (count < V1_ANALYZE_RETRY):
+                return self.scheduler.schedule(
+                    get_retry_delay(count), self.analyze_urls, [order],
+                    [name], count + 1
+                )
+            return self.add_result(order, (name, res, task, None, None))
+        keys = []
+        if self.cache is not None:
+            keys.append('url:' + normalize_url(name))
+        self.download(self.save_report, order, keys, name, res, task, result,
+                      'sandbox_analysis_url')
+
+    def save_report(self, order, keys, name, res, task, result,
+                    file_name_prefix):
+        file_name = fetch_analysis_report(self.v1, result, file_name_prefix)
+        for key in keys:
+            self.cache.put(key, task, result, file_name)
+        self.add_result(order, (name, res, task, result, file_name))
+
+
+def analyze_file(v1, infile, name, archive_password, document_password,
+                 quota=None, cache=None, on_result=None, known_hashes=None,
+                 expand_archives=False):
+    analyzer = SandboxAnalyzer(v1, quota, cache, 1, on_result, known_hashes,
+                               expand_archives)
+    analyzer.submit_file(infile, name, archive_password, document_password)
+    return analyzer.join()[0]
+
+
+def analyze_urls(v1, url, cache=None, on_result=None, quota=None,
+                 concurrency=V1_MAX_WORKERS):
+    analyzer = SandboxAnalyzer(v1, quota, cache, concurrency, on_result)
+    analyzer.submit_urls(url)
+    return analyzer.join()
+
+
+def analyze_files(v1, paths, archive_password, document_password,
+                  concurrency=V1_MAX_WORKERS, cache=None, on_result=None,
+                  known_hashes=None, expand_archives=False):
+    # the quota is checked when a file is not found in the cache or hash
+    # lists, and the submissions in progress are limited to concurrency
+    quota = SubmissionQuota(v1)
+    max_workers = max(1, min(concurrency, len(paths)))
+    analyzer = SandboxAnalyzer(v1, quota, cache, max_workers, on_result,
+                               known_hashes, expand_archives, concurrency)
+    for path in paths:
+        analyzer.submit_file(path, path, archive_password, document_password)
+    return analyzer.join()
+
+
+def print_result(r):
+    (name, res, task, result, file_name) = r
+    if task is None:
+        error = res.get('body', {}).get('error', '')
+        print(f'Unable to start analyzing "{name}" task. '
+              f'Error code: {error}')
+        return
+    status = task['status']
+    if not result:
+        if 'running' == status:
+            print(f'The status of the analyzing "{name}" task is '
+                  f'"{status}". Task ID: {task["id"]}')
+        elif 'failed' == status:
+            error = task.get('error', {})
+            error_code = error.get('code', '')
+            if 'Unsupported' == error_code:
+                print(f'Unable to analyze "{name}". Object not supported.')
+            else:
+                print(f'The status of the analyzing "{name}" task is '
+                      f'"{status}". Error code: {error}')
+        return
+    risk_level = result['riskLevel']
+    # no submission response for results found in the cache
+    if (res is None) and ('succeeded' == status):
+        status = 'cached'
+    if not file_name:
+        print(f'Analyzing: "{name}"; Task status: {status}; '
+              f'Risk level: {risk_level}.')
+        return
+    print(f'Analyzing: "{name}"; Task status: {status}; Risk level: '
+          f'{risk_level}; Analysis report saved to: {file_name}.')
 
 
 def main(v1_token, v1_url, infile=None, name=None, archive_password=None,
-         document_password=None, url=None):
+         document_password=None, url=None, paths=None,
+         concurrency=V1_MAX_WORKERS, cache=V1_VERDICT_CACHE,
+         cache_ttl=V1_VERDICT_TTL, url_file=None, allowlist=None,
+         blocklist=None, expand_archives=False):
     v1 = TmV1Client(v1_token, v1_url)
-
-    r = v1.get_sandbox_sumbission_usage()
-    remaining_count = r['submissionRemainingCount']
-    if not (0 < remaining_count):
-        raise RuntimeError('No submissions available in the daily reserve')
-    print(f'Submissions available: {remaining_count}')
+    verdict_cache = VerdictCache(cache, cache_ttl) if cache else None
+    known_hashes = None
+    if allowlist or blocklist:
+        known_hashes = KnownHashes(allowlist or [], blocklist or [])
 
     results = []
     if infile is not None:
@@ -312,46 +1222,41 @@ def main(v1_token, v1_url, infile=None, name=None, archive_password=None,
                 raise ValueError('file_name must be specified for '
                                  f'{infile.name}')
             name = os.path.basename(infile.name)
-        print(f'Submitting 1 file...')
+        if not infile.seekable():
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(infile, spool)
+            infile = spool
+        print('Submitting 1 file...')
         r = analyze_file(v1, infile, name, archive_password,
-                         document_password)
+                         document_password, quota=SubmissionQuota(v1),
+                         cache=verdict_cache,
+                         on_result=print_result, known_hashes=known_hashes,
+                         expand_archives=expand_archives)
         results.append(r)
+    elif paths is not None:
+        paths = expand_file_paths(paths)
+        if not paths:
+            raise ValueError('No file found')
+        print(f'Submitting {len(paths)} files...')
+        r = analyze_files(v1, paths, archive_password, document_password,
+                          concurrency, verdict_cache, print_result,
+                          known_hashes, expand_archives)
+        results.extend(r)
     elif url is not None:
+        if url_file is not None:
+            url = url + [line.strip() for line in url_file if line.strip()]
         if not url:
             raise ValueError('No URL specified')
-        url_count = len(url)
+        url_count = len(get_unique_urls(url))
         print(f'Submitting {url_count} URLs...')
-        r = analyze_urls(v1, url)
+        r = analyze_urls(v1, url, verdict_cache, print_result,
+                         SubmissionQuota(v1), concurrency)
         results.extend(r)
-
-    print('')
-    for (name, res, task, result, file_name) in results:
-        if task is None:
-            error = res.get('body', {}).get('error', '')
-            print(f'Unable to start analyzing "{name}" task. '
-                  f'Error code: {error}')
-            continue
-        status = task['status']
-        if not result:
-            if 'running' == status:
-                print(f'The status of the analyzing "{name}" task is '
-                      f'"{status}". Task ID: {task["id"]}')
-            elif 'failed' == status:
-                error = task.get('error', {})
-                error_code = error.get('code', '')
-                if 'Unsupported' == error_code:
-                    print(f'Unable to analyze "{name}". Object not supported.')
-                else:
-                    print(f'The status of the analyzing "{name}" task is '
-                          f'"{status}". Error code: {error}')
-            continue
-        risk_level = result['riskLevel']
-        if not file_name:
-            print(f'Analyzing: "{name}"; Task status: {status}; '
-                  f'Risk level: {risk_level}.')
-            continue
-        print(f'Analyzing: "{name}"; Task status: {status}; Risk level: '
-              f'{risk_level}; Analysis report saved to: {file_name}.')
+    if verdict_cache is not None:
+        verdict_cache.close()
+    if known_hashes is not None:
+        known_hashes.close()
+    return results
 
 
 if __name__ == '__main__':
@@ -370,6 +1275,31 @@ if __name__ == '__main__':
         '-u', '--v1-url', default=TmV1Client.base_url_default,
         help=('URL of the Trend Vision One server for your region.'
               f' The default value is "{TmV1Client.base_url_default}"'))
+    parser.add_argument(
+        '--cache', default=V1_VERDICT_CACHE,
+        help=('SQLite file of analysis results keyed by file SHA-256 or'
+              ' normalized URL. Objects found in the cache are not'
+              ' submitted again.'))
+    parser.add_argument(
+        '--cache-ttl', type=int, default=V1_VERDICT_TTL,
+        help=('Seconds for which a cached analysis result is used. The'
+              f' default value is {V1_VERDICT_TTL}'))
+    parser.add_argument(
+        '--allowlist', action='append',
+        help=('Text file of known good SHA-1 or SHA-256 hashes, one per line.'
+              ' Matching files are reported without being submitted. A'
+              ' sorted index file is built next to the list on first use.'
+              ' Can be specified multiple times.'))
+    parser.add_argument(
+        '--blocklist', action='append',
+        help=('Text file of known malicious SHA-1 or SHA-256 hashes, one per'
+              ' line. Matching files are reported as high risk without being'
+              ' submitted. Can be specified multiple times.'))
+    parser.add_argument(
+        '-x', '--expand-archives', action='store_true',
+        help=('Expand zip and tar archives locally and submit only the'
+              ' members not found in the cache or hash lists, repacked in a'
+              ' zip archive'))
     subparsers = parser.add_subparsers(help='')
     file_parser = subparsers.add_parser(
         'file', help='Submit file to the sandbox.',
@@ -392,6 +1322,26 @@ if __name__ == '__main__':
     file_parser.add_argument(
         '-d', '--document-password',
         help='Password used to decrypt the submitted file.')
+    files_parser = subparsers.add_parser(
+        'files', help='Submit files to the sandbox concurrently.',
+        epilog=(f'Example: python {os.path.basename(__file__)} files'
+                ' -c 8 /path/to/dir "/path/to/attachments/*.eml"')
+    )
+    files_parser.add_argument(
+        'paths', nargs='+',
+        help=('Files, directories or glob patterns of the files to be sent'
+              ' to the sandbox. Directories are searched recursively.'))
+    files_parser.add_argument(
+        '-p', '--archive-password',
+        help='Password used to decrypt the submitted archives.')
+    files_parser.add_argument(
+        '-d', '--document-password',
+        help='Password used to decrypt the submitted files.')
+    files_parser.add_argument(
+        '-c', '--concurrency', type=int, default=V1_MAX_WORKERS,
+        help=('Maximum number of files analyzed at the same time. The value'
+              ' is also limited by the submissions available in the daily'
+              f' reserve. The default value is {V1_MAX_WORKERS}'))
     url_parser = subparsers.add_parser(
         'url', help='Submit URLs to the sandbox.',
         epilog=(f'Example: python {os.path.basename(__file__)} url'
@@ -400,4 +1350,14 @@ if __name__ == '__main__':
     url_parser.add_argument(
         'url', nargs='*',
         help=('URL to be submitted. A number of URLs can be specified.'))
+    url_parser.add_argument(
+        '-f', '--url-file', type=argparse.FileType('r'),
+        help=('File with one URL per line to be submitted in addition to the'
+              " URL arguments. Specify '-' for stdin. URLs that are the same"
+              ' after normalization are submitted once.'))
+    url_parser.add_argument(
+        '-c', '--concurrency', type=int, default=V1_MAX_WORKERS,
+        help=(f'Maximum number of requests of {V1_URL_CHUNK_SIZE} URLs'
+              ' submitted at the same time. The default value is'
+              f' {V1_MAX_WORKERS}'))
     main(**vars(parser.parse_args()))